@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Background writing of training artifacts (images, gifs, plots and html pages).
+
+Encoding gifs and pngs takes far longer than a training update, so the training loop only copies the data off the
+device and hands it to a worker thread. Pending artifacts are keyed by their file path: a newer artifact for a path
+that is still waiting replaces the older one, and when too many paths are waiting new artifacts are dropped, so a
+slow disk never stalls training. Everything pending is written on close, which also runs at interpreter exit.
+"""
+import atexit
+import collections
+import threading
+
+import numpy as np
+import torch
+import torchvision.utils as vutils
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+def save_loss_plot(fpath, losses, legend, styles=None, title="Image reconstruction loss vs timestep"):
+    """Plots per-timestep losses without pyplot's global state, so it is safe to call from the writer thread."""
+    if styles is None:
+        styles = ['-'] * len(losses)
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    for loss, style in zip(losses, styles):
+        ax.plot(loss, style)
+
+    ax.set_title(title)
+    ax.set_ylabel("loss (MSE)")
+    ax.set_xlabel("timestep")
+    ax.legend(legend)
+    fig.savefig(fpath)
+
+
+def write_text(fpath, text):
+    with open(fpath, 'w') as f:
+        f.write(text)
+
+
+class ArtifactWriter(object):
+    """Writes artifacts on a worker thread through a bounded set of pending file paths.
+
+    :param max_pending: file paths that may wait at once, artifacts for further paths are dropped
+    """
+    def __init__(self, max_pending=16):
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.n_busy = 0
+        self.n_written = 0
+        self.n_coalesced = 0
+        self.n_dropped = 0
+        self.errors = []
+
+        self.cond = threading.Condition()
+        self.closed = False
+        self.worker = threading.Thread(target=self._work)
+        self.worker.daemon = True
+        self.worker.start()
+        atexit.register(self.close)
+
+    def submit(self, fpath, fn, *args, block=False, **kwargs):
+        """Schedules fn(*args, **kwargs) to write fpath, the arguments must not be modified afterwards.
+
+        :param block: wait for a free slot instead of dropping the artifact, for artifacts that must be written
+        :return: False if the artifact was dropped
+        """
+        with self.cond:
+            if self.closed:
+                raise ValueError('Artifact writer is closed', fpath)
+
+            if fpath in self.pending:
+                self.n_coalesced += 1
+            elif len(self.pending) >= self.max_pending:
+                if not block:
+                    self.n_dropped += 1
+                    return False
+                while len(self.pending) >= self.max_pending:
+                    self.cond.wait()
+
+            self.pending[fpath] = (fn, args, kwargs)
+            self.cond.notify_all()
+
+        return True
+
+    def save_image(self, tensor, fpath, **kwargs):
+        """torchvision.utils.save_image of a copy of tensor taken now."""
+        tensor = tensor.detach().to('cpu', torch.float32, copy=True)
+        return self.submit(fpath, vutils.save_image, tensor, fpath, **kwargs)
+
+    def save_gif(self, fn, batch_eps, fpath, **kwargs):
+        """fn(copy of batch_eps, fpath, **kwargs), e.g. with my_utils.batch_to_sequence."""
+        return self.submit(fpath, fn, np.array(batch_eps, dtype='float32'), fpath, **kwargs)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+
+                fpath, (fn, args, kwargs) = self.pending.popitem(last=False)
+                self.n_busy += 1
+
+            try:
+                fn(*args, **kwargs)
+                written = 1
+            except Exception as e:
+                # an artifact failing to write must not take training down
+                self.errors.append((fpath, e))
+                print('Failed to write {}: {}'.format(fpath, e))
+                written = 0
+
+            with self.cond:
+                self.n_busy -= 1
+                self.n_written += written
+                self.cond.notify_all()
+
+    def flush(self):
+        """Blocks until every pending artifact is written."""
+        with self.cond:
+            while self.pending or self.n_busy > 0:
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+
+        self.worker.join()
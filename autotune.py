@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Picks the largest PAE batch size whose training update fits a memory budget.
+
+The memory of an update is dominated by the activations autograd saves for the backward pass of the belief state
+propagator and decoder, which grow linearly with the number of episodes. They are measured exactly, with saved
+tensor hooks, for batches of one and two episodes; the same counts hold on any device, so the estimate runs on CPU.
+Parameters, gradients and the two Adam moments are added on top.
+"""
+import torch
+
+import models
+
+# weights, gradients and two Adam moments
+PARAM_COPIES = 4
+
+
+def update_activation_bytes(net, ep_len, batch_size):
+    """Bytes of the tensors saved for backward by bs_prop and decoder, plus the input, target and output batches."""
+    obs = torch.zeros(ep_len, batch_size, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        states = net.bs_prop(obs)
+        net.decoder(states.view(ep_len * batch_size, -1))
+
+    # obs_in, obs_out and the expected observations
+    return sum(storages.values()) + 3 * obs.numel() * obs.element_size()
+
+
+def param_bytes(net):
+    return PARAM_COPIES * sum(p.numel() * p.element_size() for p in net.parameters())
+
+
+def auto_batch_size(net, ep_len, memory_budget, max_batch_size=1024):
+    """
+    :param net: PAEGAN on CPU, only used for measuring
+    :param memory_budget: bytes one training update may use
+    :return: largest batch size (at most max_batch_size) whose estimated update memory fits memory_budget
+    """
+    one = update_activation_bytes(net, ep_len, 1)
+    per_episode = update_activation_bytes(net, ep_len, 2) - one
+    fixed = param_bytes(net) + one - per_episode
+
+    batch_size = int((memory_budget - fixed) // per_episode)
+    if batch_size < 1:
+        raise ValueError('Memory budget too small for a single episode', memory_budget, fixed + per_episode)
+
+    return min(batch_size, max_batch_size)
@@ -6,6 +6,9 @@ WORLD_LEN = 28
 WORLD_SIZE = np.array((WORLD_LEN, WORLD_LEN))
 V_STD = 0.8
 P_BOUNCE = 0.5
+# the 'auto' broadphase hashes bodies into a grid from this many bodies on, below it the hashing costs more than
+# checking every pair (bench_collisions.py)
+GRID_MIN_BODIES = 8
 
 DEFAULT_SIM_CONFIG = {
     'n_bodies': 1,
@@ -17,6 +20,7 @@ DEFAULT_SIM_CONFIG = {
     'ball_action': 'pass',
     'measurement_noise': 0.0,
     'dynamics_noise': 0.001,
+    'broadphase': 'auto',
 }
 
 
@@ -41,6 +45,38 @@ class Body(object):
         return np.linalg.norm(self.pos - other_body.pos) < (self.r + other_body.r)
 
 
+def grid_candidate_pairs(pos, max_radius):
+    """Uniform-grid broadphase for ball-ball collisions.
+
+    Bodies are hashed into square cells at least 2 * max_radius wide, so any two colliding bodies sit in the same or
+    in neighbouring cells and only those pairs are returned. Bodies outside the world (bouncing walls let them poke
+    out) are clamped into the border cells, which never separates neighbours. Neighbourhoods do not wrap around the
+    world edges, since World.bounce_pair measures plain, unwrapped distances.
+
+    :param pos: (n_bodies, 2) positions
+    :param max_radius: largest body radius
+    :return: sorted list of candidate (i, j) pairs with i < j
+    """
+    n_cells = max(1, int(WORLD_LEN // (2 * max_radius)))
+    cells = np.floor(np.asarray(pos) * n_cells / WORLD_LEN).astype('int64')
+    cells = np.clip(cells, 0, n_cells - 1)
+
+    grid = {}
+    for i, cell in enumerate(map(tuple, cells)):
+        grid.setdefault(cell, []).append(i)
+
+    pairs = set()
+    for (cx, cy), members in grid.items():
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in grid.get((cx + dx, cy + dy), ()):
+                    for i in members:
+                        if i < j:
+                            pairs.add((i, j))
+
+    return sorted(pairs)
+
+
 class World(object):
     def __init__(self, **kwargs):
         self.n_bodies = kwargs['n_bodies']
@@ -51,6 +87,9 @@ class World(object):
 
         self.measurement_noise = kwargs['measurement_noise']
         self.dynamics_noise = kwargs['dynamics_noise']
+        self.broadphase = kwargs.get('broadphase', 'auto')
+        if self.broadphase == 'auto':
+            self.broadphase = 'grid' if self.n_bodies >= GRID_MIN_BODIES else 'brute'
 
         radius = kwargs['radius']
         if self.radius_mode == 'uniform':
@@ -191,27 +230,39 @@ class World(object):
             pass
         elif self.ball_action == 'bounce':
             # bounce balls
-            for i, b1 in enumerate(self.bodies):
-                # avoid repeating the check
-                for b2 in self.bodies[i:]:
-                    if b1 is b2:
-                        continue
-
-                    d12 = b1.pos - b2.pos
-                    d12_norm = np.linalg.norm(d12)
-                    if d12_norm < (b1.r + b2.r):
-                        # if collision between balls
-                        m1_c = (2 * b2.m) / (b2.m + b1.m)
-                        m2_c = (2 * b1.m) / (b2.m + b1.m)
-                        v12 = b1.vel - b2.vel
-                        v1_c = np.dot(v12, d12) * (d12 / d12_norm ** 2)
-                        v2_c = np.dot(-v12, -d12) * (-d12 / d12_norm ** 2)
-
-                        b1.vel -= m1_c * v1_c
-                        b2.vel -= m2_c * v2_c
+            if self.broadphase == 'brute':
+                for i, b1 in enumerate(self.bodies):
+                    # avoid repeating the check
+                    for b2 in self.bodies[i:]:
+                        if b1 is b2:
+                            continue
+                        self.bounce_pair(b1, b2)
+            elif self.broadphase == 'grid':
+                # candidates come sorted, so colliding pairs are resolved in the brute-force order
+                pos = np.array([body.pos for body in self.bodies])
+                max_r = max(body.r for body in self.bodies)
+                for i, j in grid_candidate_pairs(pos, max_r):
+                    self.bounce_pair(self.bodies[i], self.bodies[j])
+            else:
+                raise ValueError('Bad broadphase', self.broadphase)
         else:
             raise ValueError('Bad ball_action', self.ball_action)
 
+    @staticmethod
+    def bounce_pair(b1, b2):
+        d12 = b1.pos - b2.pos
+        d12_norm = np.linalg.norm(d12)
+        if d12_norm < (b1.r + b2.r):
+            # if collision between balls
+            m1_c = (2 * b2.m) / (b2.m + b1.m)
+            m2_c = (2 * b1.m) / (b2.m + b1.m)
+            v12 = b1.vel - b2.vel
+            v1_c = np.dot(v12, d12) * (d12 / d12_norm ** 2)
+            v2_c = np.dot(-v12, -d12) * (-d12 / d12_norm ** 2)
+
+            b1.vel -= m1_c * v1_c
+            b2.vel -= m2_c * v2_c
+
     def draw_centres(self):
         board = np.zeros(WORLD_SIZE)
         for body in self.bodies:
@@ -250,17 +301,158 @@ class World(object):
         return nums.astype('float32')
 
 
+class VectorWorld(object):
+    """Steps n_worlds independent copies of World at once.
 
+    Body state is kept in (n_worlds, n_bodies, 2) position, velocity and measured position arrays and
+    (n_worlds, n_bodies) radius, mass and wall flag arrays, and every World.run step for every wall_action and
+    ball_action mode becomes a handful of array operations over all worlds.
 
+    Random numbers come from random_state: None uses the global np.random state (so np.random.seed keeps runs
+    reproducible, as in structured_recorder), an int seeds a private np.random.RandomState.
+    """
+    def __init__(self, n_worlds, random_state=None, **kwargs):
+        self.n_worlds = n_worlds
+        self.n_bodies = kwargs['n_bodies']
+        self.radius_mode = kwargs['radius_mode']
+        self.mass_mode = kwargs['mass_mode']
+        self.wall_action = kwargs['wall_action']
+        self.ball_action = kwargs['ball_action']
 
+        self.measurement_noise = kwargs['measurement_noise']
+        self.dynamics_noise = kwargs['dynamics_noise']
 
+        if random_state is None:
+            self.random = np.random
+        elif isinstance(random_state, np.random.RandomState):
+            self.random = random_state
+        else:
+            self.random = np.random.RandomState(random_state)
 
+        radius = kwargs['radius']
+        if self.radius_mode == 'uniform':
+            radii = np.full(self.n_bodies, radius, dtype='float64')
+        else:
+            raise ValueError('Bad radius_mode', self.radius_mode)
 
+        # same rule as World
+        mass = kwargs.get('mass', 1.0)
+        masses = np.full(self.n_bodies, mass, dtype='float64')
+
+        self.radii = np.tile(radii, (n_worlds, 1))
+        self.masses = np.tile(masses, (n_worlds, 1))
+
+        self.pos = np.zeros((n_worlds, self.n_bodies, 2))
+        self.vel = np.zeros((n_worlds, self.n_bodies, 2))
+        self.bounce = self.random.rand(n_worlds, self.n_bodies) > P_BOUNCE
+        self.in_transition = np.zeros((n_worlds, self.n_bodies), dtype='bool')
+
+        self.spawn()
+        self.measured_pos = np.copy(self.pos)
+
+    def spawn(self):
+        """Draws initial states like World.spawn, redrawing overlapping bodies world-wise."""
+        for j in range(self.n_bodies):
+            redo = np.ones(self.n_worlds, dtype='bool')
+            while np.any(redo):
+                n_redo = np.count_nonzero(redo)
+                r = self.radii[redo, j, None]
+                # uniform in the box that keeps the body off the walls
+                self.pos[redo, j] = r + (WORLD_LEN - 2 * r) * self.random.rand(n_redo, 2)
+                self.vel[redo, j] = V_STD * self.random.randn(n_redo, 2)
+
+                redo[:] = False
+                for k in range(j):
+                    dist = np.linalg.norm(self.pos[:, j] - self.pos[:, k], axis=-1)
+                    redo |= dist < (self.radii[:, j] + self.radii[:, k])
+
+    def take(self, indices):
+        """Replaces the worlds by the worlds at indices, eg. to resample particles."""
+        self.pos = self.pos[indices]
+        self.vel = self.vel[indices]
+        self.measured_pos = self.measured_pos[indices]
+        self.radii = self.radii[indices]
+        self.masses = self.masses[indices]
+        self.bounce = self.bounce[indices]
+        self.in_transition = self.in_transition[indices]
+        self.n_worlds = len(self.pos)
 
+    def total_momentum(self):
+        return np.sum(self.vel * self.masses[..., None], axis=(1, 2))
 
+    def total_kinetic_e(self):
+        return np.sum(np.sum(self.vel ** 2, axis=-1) * self.masses, axis=-1) / 2.0
 
+    def run(self, dt=1.0, measure=True):
+        # state and measurement update
+        dv = self.dynamics_noise * self.random.randn(*self.vel.shape)
+        self.pos += dt * self.vel + (dv * dt**2 / 2)
+        self.vel += dv * dt
+
+        if measure:
+            self.measured_pos = np.copy(self.pos)
+            if self.measurement_noise != 0.0:
+                self.measured_pos += self.measurement_noise * self.random.randn(*self.pos.shape)
+
+        self._wall_action()
+        self._ball_action()
+
+    def _bounce_off_walls(self, mask=None):
+        r = self.radii[..., None]
+        above_lim = (self.pos + r) > WORLD_LEN
+        below_lim = (self.pos - r) < 0
+        if mask is not None:
+            above_lim &= mask[..., None]
+            below_lim &= mask[..., None]
+
+        self.vel[above_lim] = -np.abs(self.vel[above_lim])
+        self.vel[below_lim] = np.abs(self.vel[below_lim])
+
+    def _wall_action(self):
+        if self.wall_action == 'pass':
+            # reappear target on other side
+            self.pos %= WORLD_LEN
+        elif self.wall_action == 'bounce':
+            self._bounce_off_walls()
+        elif self.wall_action == 'random':
+            r = self.radii[..., None]
+            over_edge = np.any(((self.pos + r) > WORLD_LEN) | ((self.pos - r) < 0), axis=-1)
+            was_in_transition = self.in_transition
+
+            # decide whether to bounce or pass for bodies that just touched a wall
+            touched = over_edge & ~was_in_transition
+            bounce = touched & (self.random.rand(*touched.shape) < P_BOUNCE)
+            self._bounce_off_walls(bounce)
+
+            # bodies in transition are wrapped, whether they continue or finish transitioning
+            self.pos[was_in_transition] %= WORLD_LEN
+            self.in_transition = (was_in_transition & over_edge) | (touched & ~bounce)
+        elif self.wall_action == 'mixed':
+            self._bounce_off_walls(self.bounce)
+            self.pos[~self.bounce] %= WORLD_LEN
+        else:
+            raise ValueError('Bad wall_action', self.wall_action)
 
+    def _ball_action(self):
+        if self.ball_action == 'pass':
+            pass
+        elif self.ball_action == 'bounce':
+            # pairs are visited in the same order as World.run, so velocities update identically
+            for i in range(self.n_bodies):
+                for j in range(i + 1, self.n_bodies):
+                    d12 = self.pos[:, i] - self.pos[:, j]
+                    d12_norm = np.linalg.norm(d12, axis=-1)
+                    hit = np.nonzero(d12_norm < (self.radii[:, i] + self.radii[:, j]))[0]
+                    if len(hit) == 0:
+                        continue
 
+                    d12 = d12[hit]
+                    m1 = self.masses[hit, i, None]
+                    m2 = self.masses[hit, j, None]
+                    v12 = self.vel[hit, i] - self.vel[hit, j]
+                    v_c = np.sum(v12 * d12, axis=-1, keepdims=True) * d12 / d12_norm[hit, None] ** 2
 
-
-
+                    self.vel[hit, i] -= (2 * m2) / (m1 + m2) * v_c
+                    self.vel[hit, j] += (2 * m1) / (m1 + m2) * v_c
+        else:
+            raise ValueError('Bad ball_action', self.ball_action)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Background batch preparation for training.
+
+Worker threads draw episodes from a DataContainer getter, mask them and lay them out as (T, B, C, H, W) float32
+tensors ahead of time, so the training step only copies a ready batch into its input buffers.
+"""
+import queue
+import threading
+
+import numpy as np
+import torch
+
+import my_utils
+
+
+def prepare_batch(batch, p_mask, out_masked=None, out_batch=None, generator=None):
+    """Converts a (B, T, H, W, C) batch to (T, B, C, H, W) float32 and masks a copy with per-episode masks.
+
+    :param out_masked: optional float32 tensor to write the masked batch into
+    :param out_batch: optional float32 tensor to write the unmasked batch into
+    :param generator: optional torch.Generator for the masks
+    :return: masked, batch, mask with mask a (T, B) bool tensor, True for removed percepts
+    """
+    batch = batch.transpose((1, 0, 4, 2, 3))
+
+    if out_masked is None or tuple(out_masked.size()) != batch.shape:
+        out_masked = torch.empty(batch.shape, dtype=torch.float32)
+        out_batch = torch.empty(batch.shape, dtype=torch.float32)
+
+    # one strided copy with the float32 cast, straight into the (possibly pinned) output
+    np.copyto(out_batch.numpy(), batch, casting='same_kind')
+
+    mask = my_utils.sample_percept_mask(batch.shape[0], batch.shape[1], p_mask, generator=generator)
+    out_masked.copy_(out_batch)
+    my_utils.apply_percept_mask_(out_masked, mask)
+
+    return out_masked, out_batch, mask
+
+
+class PrefetchingLoader(object):
+    """Prepares masked and unmasked batches on worker threads.
+
+    Batches go through bounded queues and live in a pool of reusable (optionally pinned) buffers. A batch returned
+    by get() stays valid until the next call to get(), so copy it to the device before asking for the next one.
+    With n_workers=0 batches are prepared synchronously inside get().
+
+    Every worker draws episodes and masks with its own generators, seeded from seed, and batches are handed out
+    round-robin over the workers, so the batch sequence only depends on seed and n_workers. The getter is called as
+    getter(random_state=np.random.RandomState).
+    """
+    def __init__(self, getter, p_mask, n_workers=2, queue_size=4, pin_memory=False, seed=None):
+        """
+        :param seed: int or sequence of ints seeding the workers' generators, fresh entropy if None
+        """
+        self.getter = getter
+        self.p_mask = p_mask
+        self.n_workers = n_workers
+        self.pin_memory = pin_memory
+
+        seeds = np.random.SeedSequence(seed).spawn(max(1, n_workers))
+        self.generators = []
+        for worker_seed in seeds:
+            state = worker_seed.generate_state(2)
+            torch_generator = torch.Generator()
+            torch_generator.manual_seed(int(state[1]))
+            self.generators.append((np.random.RandomState(state[0]), torch_generator))
+
+        # every buffer is either free, being filled, queued or held by the consumer
+        worker_queue_size = max(1, -(-queue_size // max(1, n_workers)))
+        n_buffers = max(1, n_workers) * (worker_queue_size + 1) + 1
+        self.buffers = [[None, None] for _ in range(n_buffers)]
+        # CUDA events marking the end of the copies out of the pinned buffers, which must finish before refilling
+        self.copied = [None] * n_buffers
+        self.free = queue.Queue()
+        for i in range(n_buffers):
+            self.free.put(i)
+        self.ready = [queue.Queue(maxsize=worker_queue_size) for _ in range(n_workers)]
+        self.next_worker = 0
+        self.held = None
+
+        self.stop_event = threading.Event()
+        self.workers = []
+        for w in range(n_workers):
+            worker = threading.Thread(target=self._work, args=(w,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _allocate(self, shape):
+        tensor = torch.empty(shape, dtype=torch.float32)
+        if self.pin_memory:
+            tensor = tensor.pin_memory()
+        return tensor
+
+    def _fill(self, i, w):
+        random_state, torch_generator = self.generators[w]
+        batch = self.getter(random_state=random_state)
+
+        if self.copied[i] is not None:
+            # a non-blocking copy to the device may still be reading the buffer
+            self.copied[i].synchronize()
+            self.copied[i] = None
+
+        out_masked, out_batch = self.buffers[i]
+        shape = (batch.shape[1], batch.shape[0], batch.shape[4], batch.shape[2], batch.shape[3])
+        if out_masked is None or tuple(out_masked.size()) != shape:
+            out_masked = self._allocate(shape)
+            out_batch = self._allocate(shape)
+            self.buffers[i] = [out_masked, out_batch]
+
+        _, _, mask = prepare_batch(batch, self.p_mask, out_masked, out_batch, generator=torch_generator)
+        return mask
+
+    def _work(self, w):
+        while not self.stop_event.is_set():
+            try:
+                i = self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                item = (i, self._fill(i, w))
+            except Exception as e:
+                # hand the error to the consumer instead of dying silently
+                item = (None, e)
+
+            while not self.stop_event.is_set():
+                try:
+                    self.ready[w].put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+        """
+        :return: masked, batch, mask with masked and batch float32 tensors of shape (T, B, C, H, W) and mask the
+            (T, B) bool tensor of removed percepts
+        """
+        if self.held is not None:
+            if self.pin_memory and torch.cuda.is_available():
+                # recorded after the copies the consumer issued from the held buffer
+                self.copied[self.held] = torch.cuda.Event()
+                self.copied[self.held].record()
+            self.free.put(self.held)
+            self.held = None
+
+        if self.n_workers == 0:
+            i = self.free.get()
+            masked_indices = self._fill(i, 0)
+        else:
+            i, masked_indices = self.ready[self.next_worker].get()
+            self.next_worker = (self.next_worker + 1) % self.n_workers
+            if i is None:
+                raise masked_indices
+
+        self.held = i
+        out_masked, out_batch = self.buffers[i]
+        return out_masked, out_batch, masked_indices
+
+    def close(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
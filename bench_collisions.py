@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmarks World.run step time against n_bodies for the brute-force and grid ball collision broadphases
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+
+import balls_sim
+
+bench_config = {
+    'n_bodies': 10,
+    'radius_mode': 'uniform',
+    'radius': 0.5,
+    'mass_mode': 'uniform',
+    'mass': 1.0,
+    'wall_action': 'pass',
+    'ball_action': 'bounce',
+    'measurement_noise': 0.0,
+    'dynamics_noise': 0.001,
+}
+
+
+def time_steps(world, n_steps):
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        world.run()
+    return (time.perf_counter() - start) / n_steps
+
+
+def bench(n_bodies, n_steps, wall_action, seed=0):
+    sim_config = dict(bench_config, n_bodies=n_bodies, wall_action=wall_action)
+
+    np.random.seed(seed)
+    world_brute = balls_sim.World(broadphase='brute', **sim_config)
+    world_grid = copy.deepcopy(world_brute)
+    world_grid.broadphase = 'grid'
+
+    # both worlds must follow the same random stream to be comparable
+    np.random.seed(seed + 1)
+    t_brute = time_steps(world_brute, n_steps)
+    np.random.seed(seed + 1)
+    t_grid = time_steps(world_grid, n_steps)
+
+    same = all(np.array_equal(b1.pos, b2.pos) and np.array_equal(b1.vel, b2.vel)
+               for b1, b2 in zip(world_brute.bodies, world_grid.bodies))
+
+    return t_brute, t_grid, same
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ball collision broadphases.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--n_bodies', default=[1, 3, 8, 10, 25, 50, 100, 200], type=int, nargs='+',
+                        help="Numbers of bodies to benchmark.")
+    parser.add_argument('--n_steps', default=50, type=int,
+                        help="Simulation steps timed per configuration.")
+    parser.add_argument('--wall_action', default='pass', type=str,
+                        choices=['pass', 'bounce', 'random', 'mixed'],
+                        help="Wall action of the benchmarked worlds.")
+    args = parser.parse_args()
+
+    print('{:>8} {:>12} {:>12} {:>8} {:>6}'.format('n_bodies', 'brute [ms]', 'grid [ms]', 'speedup', 'same'))
+    for n_bodies in args.n_bodies:
+        t_brute, t_grid, same = bench(n_bodies, args.n_steps, args.wall_action)
+        print('{:>8} {:>12.3f} {:>12.3f} {:>8.1f} {:>6}'.format(n_bodies, 1000 * t_brute, 1000 * t_grid,
+                                                              t_brute / t_grid, str(same)))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Benchmarks training updates per second of every training stage for each precision and memory layout
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import models
+import precision
+import train
+
+
+def make_update(net, stage, mixed_precision, obs_in, obs_out, gan_batch_size=train.GAN_BATCH_SIZE,
+                averaging_batch_size=train.AVERAGING_BATCH_SIZE):
+    """Returns a function running one training update of the given stage, with the same passes as train.py."""
+    ep_len, batch_size = obs_in.size(0), obs_in.size(1)
+    criterion_pae = nn.MSELoss()
+    criterion_gan = mixed_precision.fp32(nn.BCELoss())
+    criterion_gen_averaged = nn.MSELoss()
+
+    optimiser_pae = optim.Adam([{'params': net.bs_prop.parameters()},
+                                {'params': net.decoder.parameters()}], lr=0.0003)
+    optimiser_g = optim.Adam(net.G.parameters(), lr=0.0002)
+    optimiser_d = optim.Adam(net.D.parameters(), lr=0.0002)
+
+    real_labels = torch.ones(gan_batch_size, 1)
+    fake_labels = torch.zeros(gan_batch_size, 1)
+    train_d_every_n_updates = {'pae': None, 'visual-sampler': 5, 'future-sampler': 7}[stage]
+
+    def draw(n):
+        return np.random.choice(ep_len * batch_size, size=n, replace=False)
+
+    def update(i):
+        net.zero_grad()
+        losses = []
+        with mixed_precision.autocast():
+            states_nonep = net.bs_prop(obs_in).view(ep_len * batch_size, -1)
+
+            if stage != 'future-sampler':
+                obs_expectation = net.decoder(states_nonep)
+
+            if stage == 'pae':
+                losses.append(criterion_pae(obs_expectation.view(obs_in.size()), obs_out))
+            else:
+                if i % train_d_every_n_updates == 0:
+                    obs_d = obs_out.view(ep_len * batch_size, *obs_out.size()[2:])[draw(gan_batch_size)]
+                    err_d_real = criterion_gan(net.D(obs_d).view(-1, 1), real_labels)
+
+                    noise = torch.randn(gan_batch_size, models.N_SIZE)
+                    obs_sample = net.decoder(net.G(noise, states_nonep[draw(gan_batch_size)]))
+                    err_d_fake = criterion_gan(net.D(obs_sample.detach()).view(-1, 1), fake_labels)
+
+                    mixed_precision.backward((err_d_fake + err_d_real) / 2)
+                    mixed_precision.step(optimiser_d)
+
+                noise = torch.randn(gan_batch_size, models.N_SIZE)
+                obs_sample = net.decoder(net.G(noise, states_nonep[draw(gan_batch_size)].detach()))
+                losses.append(criterion_gan(net.D(obs_sample).view(-1, 1), real_labels))
+
+                draw_av = draw(1)
+                states_av = states_nonep[draw_av]
+                noise = torch.randn(averaging_batch_size, models.N_SIZE)
+                samples = net.G(noise, states_av.expand(averaging_batch_size, -1).detach())
+
+                if stage == 'visual-sampler':
+                    obs_exp = obs_expectation[draw_av]
+                    sample_av = net.decoder(samples).mean(dim=0).unsqueeze(0)
+                    losses.append(criterion_gen_averaged(sample_av, obs_exp.detach()))
+                else:
+                    future_states = net.bs_prop.rollout(torch.cat([states_av, samples], dim=0),
+                                                        train.N_STEPS_AHEAD - 1)[-1]
+                    future_decoded = net.decoder(future_states)
+                    future_exp = future_decoded[:1]
+                    future_av = future_decoded[1:].mean(dim=0).unsqueeze(0)
+                    losses.append(criterion_gen_averaged(future_av, future_exp.detach()))
+
+        mixed_precision.backward(sum(losses))
+        if stage == 'pae':
+            mixed_precision.step(optimiser_pae)
+        else:
+            mixed_precision.step(optimiser_g)
+        mixed_precision.update()
+
+    return update
+
+
+def bench(stage, precision_name, channels_last, n_updates, n_warmup=3, seed=0, ep_len=train.EP_LEN,
+          pae_batch_size=train.PAE_BATCH_SIZE, gan_batch_size=train.GAN_BATCH_SIZE,
+          averaging_batch_size=train.AVERAGING_BATCH_SIZE):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    net = models.PAEGAN()
+    if channels_last:
+        net.channels_last()
+
+    obs_out = torch.rand(ep_len, pae_batch_size, *train.BALLS_OBS_SHAPE)
+    obs_in = obs_out * (torch.rand(ep_len, pae_batch_size, 1, 1, 1) > 0.5).float()
+
+    update = make_update(net, stage, precision.Precision(precision_name), obs_in, obs_out,
+                         gan_batch_size=gan_batch_size, averaging_batch_size=averaging_batch_size)
+    for i in range(n_warmup):
+        update(i)
+
+    start = time.perf_counter()
+    for i in range(n_updates):
+        update(i)
+    return n_updates / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark training stages on CPU.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--stages', default=['pae', 'visual-sampler', 'future-sampler'], type=str, nargs='+',
+                        choices=['pae', 'visual-sampler', 'future-sampler'],
+                        help="Training stages to benchmark.")
+    parser.add_argument('--precisions', default=['fp32', 'bf16'], type=str, nargs='+',
+                        choices=['fp32', 'bf16'],
+                        help="Precisions to benchmark.")
+    parser.add_argument('--n_updates', default=20, type=int,
+                        help="Updates timed per configuration.")
+    parser.add_argument('--pae_batch_size', default=train.PAE_BATCH_SIZE, type=int,
+                        help="Episodes per update.")
+    parser.add_argument('--gan_batch_size', default=train.GAN_BATCH_SIZE, type=int,
+                        help="Frames drawn per update for the discriminator and generator.")
+    parser.add_argument('--averaging_batch_size', default=train.AVERAGING_BATCH_SIZE, type=int,
+                        help="Generator samples averaged per belief state.")
+    parser.add_argument('--ep_len', default=train.EP_LEN, type=int,
+                        help="Length of the benchmarked episodes.")
+    parser.add_argument('--n_threads', type=int,
+                        help="Torch intra-op threads, torch default if not given.")
+    args = parser.parse_args()
+
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    print('{:>16} {:>10} {:>13} {:>12}'.format('stage', 'precision', 'channels_last', 'updates/s'))
+    for stage in args.stages:
+        for precision_name in args.precisions:
+            for channels_last in (False, True):
+                updates_per_sec = bench(stage, precision_name, channels_last, args.n_updates, ep_len=args.ep_len,
+                                        pae_batch_size=args.pae_batch_size, gan_batch_size=args.gan_batch_size,
+                                        averaging_batch_size=args.averaging_batch_size)
+                print('{:>16} {:>10} {:>13} {:>12.2f}'.format(stage, precision_name, str(channels_last),
+                                                             updates_per_sec))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Fixed-seed CPU microbenchmarks of the pieces of a training update, written to json.
+
+Covers data sampling from a DataContainer (rendered on the fly and from populated images), percept masking, and the
+forward and forward+backward passes of BeliefStatePropagator, Decoder, VisualDiscriminator and BeliefStateGenerator,
+each at every combination of batch size and episode length. The decoder sees the batch_size * ep_len frames of a
+batch as in the training loop, while the discriminator and generator, which train on drawn frames, see batch_size
+frames and are benchmarked once per batch size. Results of two commits can be compared with --compare.
+
+Usage: python bench_training.py --output bench.json
+       python bench_training.py --output new.json --compare old.json
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import columnar_record
+import models
+import my_utils
+import structured_recorder
+from structured_container import DataContainer
+
+BENCH_N_EPISODES = 64
+
+
+def time_fn(fn, n_repeats, n_warmup=2):
+    for _ in range(n_warmup):
+        fn()
+
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return {'mean_s': float(np.mean(times)), 'min_s': float(np.min(times)), 'std_s': float(np.std(times)),
+            'n_repeats': n_repeats}
+
+
+def forward_backward(module, *inputs):
+    def run():
+        module.zero_grad()
+        out = module(*inputs)
+        out.float().mean().backward()
+    return run
+
+
+def forward(module, *inputs):
+    def run():
+        with torch.no_grad():
+            module(*inputs)
+    return run
+
+
+def data_benchmarks(record_dir, batch_size, ep_len):
+    container = DataContainer(record_dir, batch_size=batch_size, ep_len_read=ep_len)
+    yield 'data.sample_rendered', container.get_batch_episodes
+
+    container.populate_images()
+    yield 'data.sample_populated', container.get_batch_episodes
+
+    batch = container.get_batch_episodes()
+    yield 'mask_percepts', lambda: my_utils.mask_percepts(batch, 0.99)
+
+
+def episode_benchmarks(net, batch_size, ep_len):
+    obs = torch.rand(ep_len, batch_size, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)
+    states = torch.rand(batch_size * ep_len, models.BS_SIZE) * 2 - 1
+
+    yield 'bs_prop.forward', forward(net.bs_prop, obs)
+    yield 'bs_prop.forward_backward', forward_backward(net.bs_prop, obs)
+    yield 'decoder.forward', forward(net.decoder, states)
+    yield 'decoder.forward_backward', forward_backward(net.decoder, states)
+
+
+def frame_benchmarks(net, batch_size):
+    frames = torch.rand(batch_size, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)
+    states = torch.rand(batch_size, models.BS_SIZE) * 2 - 1
+    noise = torch.randn(batch_size, models.N_SIZE)
+
+    yield 'D.forward', forward(net.D, frames)
+    yield 'D.forward_backward', forward_backward(net.D, frames)
+    yield 'G.forward', forward(net.G, noise, states)
+    yield 'G.forward_backward', forward_backward(net.G, noise, states)
+
+
+def write_bench_record(path, ep_len, seed):
+    arrays = structured_recorder.simulate_episodes(structured_recorder.simulation_config, BENCH_N_EPISODES, ep_len,
+                                                   random_state=seed)
+    columnar_record.write_columnar(path, arrays, structured_recorder.simulation_config)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(batch_sizes, ep_lens, n_repeats, seed=0, only=None):
+    """
+    :param only: optional list of benchmark name prefixes to run
+    :return: list of result dicts with 'benchmark', 'batch_size', 'ep_len' (None for per-frame benchmarks) and
+        the timings
+    """
+    record_dir = tempfile.mkdtemp(prefix='bench_record_')
+    results = []
+    try:
+        write_bench_record(record_dir, max(ep_lens), seed)
+
+        torch.manual_seed(seed)
+        net = models.PAEGAN()
+
+        suites = []
+        for batch_size in batch_sizes:
+            suites.append((batch_size, None, frame_benchmarks(net, batch_size)))
+            for ep_len in ep_lens:
+                suites.append((batch_size, ep_len, data_benchmarks(record_dir, batch_size, ep_len)))
+                suites.append((batch_size, ep_len, episode_benchmarks(net, batch_size, ep_len)))
+
+        for batch_size, ep_len, suite in suites:
+            for name, fn in suite:
+                if only and not any(name.startswith(prefix) for prefix in only):
+                    continue
+
+                np.random.seed(seed)
+                torch.manual_seed(seed)
+                result = {'benchmark': name, 'batch_size': batch_size, 'ep_len': ep_len}
+                result.update(time_fn(fn, n_repeats))
+                results.append(result)
+                print('{:>28} {:>6} {:>6} {:>12.3f}'.format(name, batch_size, str(ep_len), 1000 * result['mean_s']))
+    finally:
+        shutil.rmtree(record_dir)
+
+    return results
+
+
+def compare(results, reference):
+    """Prints the speedup of results over reference for every benchmark present in both."""
+    def key(r):
+        return r['benchmark'], r['batch_size'], r['ep_len']
+
+    reference = {key(r): r for r in reference}
+    print('{:>28} {:>6} {:>6} {:>12} {:>12} {:>8}'.format('benchmark', 'batch', 'ep_len', 'ref [ms]', 'new [ms]',
+                                                          'speedup'))
+    for r in results:
+        if key(r) in reference:
+            ref_s = reference[key(r)]['mean_s']
+            print('{:>28} {:>6} {:>6} {:>12.3f} {:>12.3f} {:>8.2f}'.format(
+                r['benchmark'], r['batch_size'], str(r['ep_len']), 1000 * ref_s, 1000 * r['mean_s'], ref_s / r['mean_s']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pieces of a training update on CPU.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output', default='bench_training.json', type=str,
+                        help="Json file for the results.")
+    parser.add_argument('--batch_sizes', default=[1, 4, 16, 64], type=int, nargs='+',
+                        help="Batch sizes (episodes) to benchmark.")
+    parser.add_argument('--ep_lens', default=[25, 100], type=int, nargs='+',
+                        help="Episode lengths to benchmark.")
+    parser.add_argument('--n_repeats', default=10, type=int,
+                        help="Timed repetitions per benchmark.")
+    parser.add_argument('--seed', default=0, type=int,
+                        help="Seed of the data and the networks.")
+    parser.add_argument('--only', type=str, nargs='+',
+                        help="Run only benchmarks whose name starts with one of these, e.g. data bs_prop.")
+    parser.add_argument('--n_threads', type=int,
+                        help="Torch intra-op threads, torch default if not given.")
+    parser.add_argument('--compare', type=str,
+                        help="Json results of another run to compare against.")
+    args = parser.parse_args()
+
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    results = run(args.batch_sizes, args.ep_lens, args.n_repeats, seed=args.seed, only=args.only)
+
+    report = {
+        'meta': {
+            'git_commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'torch_version': torch.__version__,
+            'numpy_version': np.__version__,
+            'n_threads': torch.get_num_threads(),
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Columnar on-disk format for recorded episodes.
+
+A record is a directory with one .npy file per column and a small header.json:
+    poses.npy, vels.npy, measures.npy   (n_episodes, episode_length, n_bodies, 2)
+    radii.npy, masses.npy               (n_episodes, n_bodies)
+The arrays are memory-mapped on load, so opening a record costs nothing and episodes are read on demand.
+
+Usage: python columnar_record.py generated-data/train.pt generated-data/train
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+STEP_COLUMNS = ('poses', 'vels', 'measures')
+EPISODE_COLUMNS = ('radii', 'masses')
+
+
+def episodes_to_arrays(episodes, dtype='float32'):
+    """Converts nested episode dicts (as stored in .pt records) to dense column arrays."""
+    arrays = {}
+    for column in STEP_COLUMNS:
+        arrays[column] = np.array([[t[column] for t in ep['t_list']] for ep in episodes], dtype=dtype)
+    for column in EPISODE_COLUMNS:
+        arrays[column] = np.array([ep[column] for ep in episodes], dtype=dtype)
+
+    return arrays
+
+
+def arrays_to_episodes(arrays, indices=None):
+    """Converts column arrays back to nested episode dicts, optionally only the episodes at indices."""
+    if indices is None:
+        indices = range(len(arrays['radii']))
+
+    episodes = []
+    for i in indices:
+        ep_dict = {}
+        for column in EPISODE_COLUMNS:
+            ep_dict[column] = list(np.array(arrays[column][i]))
+
+        steps = {column: np.array(arrays[column][i]) for column in STEP_COLUMNS}
+        ep_dict['t_list'] = [{column: list(steps[column][t]) for column in STEP_COLUMNS}
+                             for t in range(len(steps['poses']))]
+        episodes.append(ep_dict)
+
+    return episodes
+
+
+def write_columnar(path, arrays, sim_config, **header_fields):
+    """
+    :param path: directory to write, created if missing
+    :param arrays: dict with STEP_COLUMNS and EPISODE_COLUMNS arrays
+    :param sim_config: simulation config stored in the header
+    :param header_fields: any extra json serialisable metadata
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    for column in STEP_COLUMNS + EPISODE_COLUMNS:
+        np.save(os.path.join(path, '{}.npy'.format(column)), np.ascontiguousarray(arrays[column]))
+
+    n_episodes, episode_length, n_bodies = arrays['poses'].shape[:3]
+    header = {
+        'format_version': FORMAT_VERSION,
+        'n_episodes': n_episodes,
+        'episode_length': episode_length,
+        'n_bodies': n_bodies,
+        'dtype': str(arrays['poses'].dtype),
+        'sim_config': sim_config,
+    }
+    header.update(header_fields)
+
+    with open(os.path.join(path, HEADER_FILE), 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def load_columnar(path, mmap=True):
+    """
+    :param path: record directory
+    :param mmap: memory-map the arrays instead of reading them
+    :return: (header, arrays) where arrays maps column names to (memory-mapped) arrays
+    """
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        header = json.load(f)
+
+    if header['format_version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported columnar record version', header['format_version'])
+
+    mmap_mode = 'r' if mmap else None
+    arrays = {}
+    for column in STEP_COLUMNS + EPISODE_COLUMNS:
+        arrays[column] = np.load(os.path.join(path, '{}.npy'.format(column)), mmap_mode=mmap_mode)
+
+    return header, arrays
+
+
+def convert(pt_file, path, dtype='float32'):
+    """Converts a .pt record written by structured_recorder.Record.write to the columnar format."""
+    # records hold numpy scalars, which the default weights_only unpickler rejects
+    record = torch.load(pt_file, weights_only=False)
+    arrays = episodes_to_arrays(record['episodes'], dtype=dtype)
+
+    extra = {key: record[key] for key in ('sim_type', 'train', 'random_seed') if key in record}
+    write_columnar(path, arrays, record['sim_config'], **extra)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a .pt record to the columnar format.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('pt_file', type=str,
+                        help="Record written by structured_recorder.")
+    parser.add_argument('output_dir', type=str,
+                        help="Directory for the columnar record.")
+    parser.add_argument('--dtype', default='float32', type=str,
+                        choices=['float32', 'float64'],
+                        help="Storage type of the arrays.")
+    args = parser.parse_args()
+
+    print('Converting {} to {}'.format(args.pt_file, args.output_dir))
+    convert(args.pt_file, args.output_dir, dtype=args.dtype)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Data-parallel training on several CPU processes.
+
+Every process (rank) holds a full PAEGAN replica, draws its own batches and computes gradients on them. Before an
+optimiser steps, the gradients of its parameters are averaged over all ranks with a single all-reduce (gloo), so the
+replicas take identical steps and stay in sync. Which optimisers step in an update depends only on the training stage
+and the update index (train_d_every_n_updates), which all ranks share, so their all-reduces line up.
+
+Launch locally with torchrun, which sets the environment read by init():
+    torchrun --standalone --nproc_per_node 4 train.py --cuda 0 ...
+"""
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init(n_threads=0):
+    """Joins the gloo process group described by the launcher's environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+
+    :param n_threads: torch intra-op threads per rank, if 0 the cores are split evenly between the ranks
+    :return: rank, world_size; 0, 1 when not started by a launcher
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+
+    dist.init_process_group('gloo')
+    if n_threads <= 0:
+        # ranks running torch's default thread count each would oversubscribe the cores
+        n_threads = max(1, len(os.sched_getaffinity(0)) // world_size)
+    torch.set_num_threads(n_threads)
+
+    return dist.get_rank(), world_size
+
+
+def is_initialised():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank_seed(seed=None):
+    """Seed of this rank, different on every rank so that ranks sample different episodes, masks and noise.
+
+    :param seed: base seed shared by all ranks, drawn by rank 0 if None
+    :return: base seed plus the rank
+    """
+    base = torch.tensor([-1 if seed is None else seed])
+    if seed is None:
+        base.random_(0, 2 ** 31 - 2 ** 16)
+    dist.broadcast(base, 0)
+    return int(base) + dist.get_rank()
+
+
+def broadcast_module(module):
+    """Overwrites parameters and buffers of module with those of rank 0."""
+    with torch.no_grad():
+        for tensor in module.state_dict().values():
+            dist.broadcast(tensor, 0)
+
+
+def average_gradients(optimiser):
+    """Averages the gradients of the parameters of optimiser over all ranks, in place.
+
+    The gradients are flattened into one buffer for a single all-reduce. Parameters without a gradient are skipped,
+    which is consistent across ranks because all of them run the same losses.
+    """
+    if not is_initialised():
+        return
+
+    grads = [p.grad for group in optimiser.param_groups for p in group['params'] if p.grad is not None]
+    if not grads:
+        return
+
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view(grad.size()))
+        offset += grad.numel()
+
+
+def average_buffers(module):
+    """Averages the floating point buffers of module over all ranks, in place.
+
+    Every rank tracks the BatchNorm running statistics of the discriminator over its own batches only, their average
+    stands for the statistics of all batches.
+    """
+    if not is_initialised():
+        return
+
+    with torch.no_grad():
+        for buffer in module.buffers():
+            if buffer.is_floating_point():
+                dist.all_reduce(buffer)
+                buffer /= dist.get_world_size()
+
+
+@contextlib.contextmanager
+def main_rank_first():
+    """The other ranks wait until rank 0 ran the block, e.g. so that a shared cache is rendered only once."""
+    if is_initialised() and dist.get_rank() != 0:
+        dist.barrier()
+    yield
+    if is_initialised() and dist.get_rank() == 0:
+        dist.barrier()
+
+
+def close():
+    if is_initialised():
+        dist.destroy_process_group()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Parallel evaluation of the particle filter against the PAE.
+
+Every run simulates a world, tracks it with a particle filter and renders the percepts. Runs are independent, so
+they are spread over a process pool, each seeded deterministically from a base seed and its run index; results do
+not depend on the number of workers. The percept sequences of all runs then go through the network in one batch.
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import torch
+
+from balls_sim import World
+from particle_filter import VectorParticleFilter
+
+RUN_LENGTH = 160
+# first percepts of every evaluation run that are never masked; training masks from my_utils.GUARANTEED_PERCEPTS on
+MEASURED_PERCEPTS = 8
+
+
+def run_seeds(runs, seed=0):
+    return [int(s) for s in np.random.SeedSequence(seed).generate_state(runs)]
+
+
+def pf_run(sim_conf, seed=None, run_length=RUN_LENGTH, p_mask=1.0, n_particles=100,
+           guaranteed=MEASURED_PERCEPTS):
+    """Simulates one run and tracks it with a particle filter.
+
+    World and the filter draw from the global np.random, which is seeded for the run and restored afterwards, so
+    the caller's random stream is left untouched.
+
+    :param seed: seed of the run, fresh entropy if None
+    :return: dict with the (run_length, 28, 28) 'percept', 'pf_belief' and 'pf_sample' images, the (run_length,)
+        'masked' percepts and the per-timestep 'pf_loss' of the belief
+    """
+    if seed is None:
+        seed = run_seeds(1, None)[0]
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return _track(sim_conf, run_length, p_mask, n_particles, guaranteed)
+    finally:
+        np.random.set_state(state)
+
+
+def _track(sim_conf, run_length, p_mask, n_particles, guaranteed):
+    w = World(**sim_conf)
+    pf = VectorParticleFilter(sim_conf, n_particles=n_particles)
+
+    pos = [body.pos for body in w.bodies]
+    vel = [body.vel for body in w.bodies]
+    pf.warm_start(pos, vel=vel)
+
+    percepts = []
+    pf_samples = []
+    pf_poses = []
+    pf_weights = []
+    masked = np.zeros(run_length, dtype=bool)
+    for i in range(run_length):
+        if i < guaranteed or np.random.rand() > p_mask:
+            measures = [body.pos + sim_conf['measurement_noise'] * np.random.randn(2) for body in w.bodies]
+            pf.update(measures)
+            pf.resample()
+        else:
+            masked[i] = True
+
+        w.run()
+        pf.predict()
+
+        percepts.append(w.draw())
+        pf_samples.append(pf.draw_sample())
+        pf_poses.append(np.copy(pf.pos))
+        pf_weights.append(np.copy(pf.w))
+
+    percepts = np.array(percepts)
+    pf_belief = pf.draw_trajectory(np.array(pf_poses), np.array(pf_weights))
+
+    return {
+        'percept': percepts.astype('float32'),
+        'pf_belief': pf_belief.astype('float32'),
+        'pf_sample': np.array(pf_samples, dtype='float32'),
+        'masked': masked,
+        'pf_loss': np.mean((percepts - pf_belief) ** 2, axis=(1, 2)),
+    }
+
+
+def _pf_run(task):
+    return pf_run(*task)
+
+
+def pf_runs(sim_conf, runs, seed=0, n_workers=None, run_length=RUN_LENGTH, p_mask=1.0, n_particles=100):
+    """Runs pf_run for every seed of run_seeds(runs, seed) on a process pool, results in run order.
+
+    :param n_workers: pool size, cpu count if None, 0 runs everything in this process
+    """
+    tasks = [(sim_conf, s, run_length, p_mask, n_particles) for s in run_seeds(runs, seed)]
+
+    if n_workers == 0:
+        return [_pf_run(task) for task in tasks]
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        results = pool.map(_pf_run, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def evaluate_batch(net, percepts, masks, n_samples=1, consistent_noise=False, batch_size=32, return_images=False):
+    """Evaluates the network on every trajectory under every mask pattern, in batched forward passes.
+
+    Belief propagation, decoding and generator sampling all run under torch.no_grad on whatever device the network
+    lives on, so the evaluation needs no GPU.
+
+    :param percepts: (n_trajectories, T, 28, 28) percepts
+    :param masks: (n_masks, T) patterns shared by all trajectories or (n_trajectories, n_masks, T), bool and True
+        where the percept is withheld from the network
+    :param n_samples: generator samples drawn from every belief state, 0 skips sampling
+    :param consistent_noise: keep the noise of every sample constant across time
+    :param batch_size: episodes (trajectory and mask pairs) per forward pass
+    :param return_images: also return the expected observations and samples
+    :return: dict with the (n_trajectories, n_masks, T) per-timestep 'expectation_mse' and, if sampling,
+        'sample_mse' averaged over samples; with return_images also the (n_trajectories, n_masks, T, 28, 28)
+        'expectation' and (n_trajectories, n_masks, n_samples, T, 28, 28) 'sample' images
+    """
+    percepts = np.asarray(percepts, dtype='float32')
+    n_trajectories, ep_len = percepts.shape[:2]
+    masks = np.asarray(masks, dtype=bool)
+    if masks.ndim == 2:
+        masks = np.broadcast_to(masks, (n_trajectories,) + masks.shape)
+    n_masks = masks.shape[1]
+
+    device = next(net.parameters()).device
+    n_episodes = n_trajectories * n_masks
+    out = {'expectation_mse': np.zeros((n_episodes, ep_len), dtype='float32')}
+    if n_samples > 0:
+        out['sample_mse'] = np.zeros((n_episodes, ep_len), dtype='float32')
+    if return_images:
+        out['expectation'] = np.zeros((n_episodes,) + percepts.shape[1:], dtype='float32')
+        if n_samples > 0:
+            out['sample'] = np.zeros((n_episodes, n_samples) + percepts.shape[1:], dtype='float32')
+
+    for start in range(0, n_episodes, batch_size):
+        # episode i is trajectory i // n_masks under mask pattern i % n_masks
+        episodes = np.arange(start, min(start + batch_size, n_episodes))
+        trajectories, patterns = episodes // n_masks, episodes % n_masks
+        b = len(episodes)
+
+        # (T, b, 1, 28, 28) targets and masked inputs
+        target = torch.from_numpy(percepts[trajectories]).transpose(0, 1).unsqueeze(2).to(device)
+        mask = torch.from_numpy(np.ascontiguousarray(masks[trajectories, patterns].T)).to(device)
+        x = target.masked_fill(mask.view(ep_len, b, 1, 1, 1), 0)
+
+        with torch.no_grad():
+            states = net.bs_prop(x)
+            expectation = net.decoder(states.view(ep_len * b, -1)).view(x.size()).float()
+            out['expectation_mse'][episodes] = ((expectation - target) ** 2).mean(dim=(2, 3, 4)).t().cpu().numpy()
+            if return_images:
+                out['expectation'][episodes] = expectation[:, :, 0].transpose(0, 1).cpu().numpy()
+
+            if n_samples > 0:
+                if consistent_noise:
+                    noise = states.new_empty(n_samples, 1, b, net.G.n_size).normal_(0, 1)
+                    noise = noise.expand(n_samples, ep_len, b, net.G.n_size)
+                else:
+                    noise = states.new_empty(n_samples, ep_len, b, net.G.n_size).normal_(0, 1)
+                states_expanded = states.unsqueeze(0).expand(n_samples, ep_len, b, states.size(-1))
+
+                samples = net.decoder(net.G(noise.reshape(-1, net.G.n_size),
+                                            states_expanded.reshape(-1, states.size(-1))))
+                samples = samples.view((n_samples,) + x.size()).float()
+                sample_mse = ((samples - target) ** 2).mean(dim=(3, 4, 5)).mean(dim=0)
+                out['sample_mse'][episodes] = sample_mse.t().cpu().numpy()
+                if return_images:
+                    out['sample'][episodes] = samples[:, :, :, 0].permute(2, 0, 1, 3, 4).cpu().numpy()
+
+    for key in out:
+        out[key] = out[key].reshape((n_trajectories, n_masks) + out[key].shape[1:])
+
+    return out
+
+
+def baseline_loss(percepts):
+    """Loss of the uninformative prediction of every run's mean pixel intensity, averaged over runs."""
+    percepts = np.asarray(percepts)
+    return np.mean([np.mean((p - np.mean(p)) ** 2) for p in percepts])
+
+
+def write_losses(fpath, pf_loss, pae_loss, baseline):
+    """Writes per-timestep losses as csv, in the column order of ims/last_test.csv."""
+    df = pd.DataFrame({'baseline': baseline,
+                       'pae loss': pae_loss,
+                       'pf loss': pf_loss},
+                      columns=['baseline', 'pae loss', 'pf loss'])
+    df.to_csv(fpath)
+
+
+def evaluate(net, sim_conf, fpath, runs=10, seed=0, n_workers=None, run_length=RUN_LENGTH, p_mask=1.0,
+             n_particles=100, consistent_noise=False, batch_size=None):
+    """Compares particle filter and PAE over many runs and writes the mean per-timestep losses to fpath.
+
+    :param batch_size: runs per forward pass of the network, all runs in one pass if None
+    :return: list of pf_run results, each extended with the network's 'pae_belief' and 'pae_sample' images and
+        the per-timestep 'pae_loss' of the belief
+    """
+    results = pf_runs(sim_conf, runs, seed=seed, n_workers=n_workers, run_length=run_length, p_mask=p_mask,
+                      n_particles=n_particles)
+
+    percepts = np.array([r['percept'] for r in results])
+    masks = np.array([r['masked'] for r in results])[:, None]
+    if batch_size is None:
+        batch_size = len(results)
+    pae = evaluate_batch(net, percepts, masks, consistent_noise=consistent_noise, batch_size=batch_size,
+                         return_images=True)
+    pae_loss = pae['expectation_mse'][:, 0]
+    for i, r in enumerate(results):
+        r['pae_belief'] = pae['expectation'][i, 0]
+        r['pae_sample'] = pae['sample'][i, 0, 0]
+        r['pae_loss'] = pae_loss[i]
+
+    baseline = baseline_loss(percepts) * np.ones(run_length)
+
+    write_losses(fpath, np.mean([r['pf_loss'] for r in results], axis=0), np.mean(pae_loss, axis=0), baseline)
+    return results
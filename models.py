@@ -16,7 +16,6 @@ D_SIZE = 64
 G_SIZE = 256
 
 N_FILTERS = 16
-EP_LEN = 100
 
 
 class Encoder(nn.Module):
@@ -39,7 +38,8 @@ class Encoder(nn.Module):
 
     def forward(self, x):
         h = self.conv_seq(x)
-        out = self.fc_seq(h.view(h.size(0), -1))
+        # reshape, the conv output is not contiguous in the channels-last layout
+        out = self.fc_seq(h.reshape(h.size(0), -1))
         return out
 
 
@@ -74,18 +74,77 @@ class BeliefStatePropagator(nn.Module):
         self.encoder = Encoder(v_size)
         self.gru = nn.GRU(v_size, bs_size, num_layers=1)
 
-    def forward(self, x):
+        self._null_update = None
+        self._null_update_key = None
+
+    def forward(self, x, hidden=None):
+        """
+        :param x: (ep_len, batch_size, C, H, W) percepts
+        :param hidden: optional (1, batch_size, bs_size) state to continue from, e.g. the last belief state of the
+            previous chunk of the episodes; zeros if None
+        :return: (ep_len, batch_size, bs_size) belief states, the last one is also the final GRU state
+        """
         ep_len = x.size(0)
         batch_size = x.size(1)
 
         h = self.encoder(x.view(ep_len * batch_size, x.size(2), x.size(3), x.size(4)))
-        out, state_f = self.gru(h.view(ep_len, batch_size, -1))
+        out, state_f = self.gru(h.view(ep_len, batch_size, -1), hidden)
+        return out
+
+    def null_update(self):
+        """(1, v_size) encoding of the null (all zero) observation that stands in for a masked percept.
+
+        The encoding is cached and only recomputed once the encoder parameters were modified (optimiser step,
+        load_state_dict) or moved to another device, or autocast was switched, so that it always has the dtype of an
+        encoding computed in place. It is detached from the graph.
+        """
+        params = list(self.encoder.parameters())
+        device_type = params[0].device.type
+        key = ((torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)) +
+               tuple((p._version, p.data_ptr()) for p in params))
+        if self._null_update is None or key != self._null_update_key:
+            null_observation = params[0].new_zeros(1, IM_CHANNELS, IM_WIDTH, IM_WIDTH)
+            with torch.no_grad():
+                self._null_update = self.encoder(null_observation)
+            self._null_update_key = key
+
+        return self._null_update
+
+    def rollout(self, belief, n_steps):
+        """Propagates belief states n_steps frames ahead without observations, in a single GRU call.
+
+        :param belief: (batch_size, bs_size) belief states, e.g. a belief together with generator samples of it
+        :return: (n_steps, batch_size, bs_size) belief states after every step
+        """
+        batch_size = belief.size(0)
+        null_updates = self.null_update().expand(n_steps, batch_size, -1)
+        out, _ = self.gru(null_updates, belief.view(1, batch_size, -1))
         return out
 
+    def step(self, observation=None, hidden=None, mask=None):
+        """Advances the belief states of a batch of episodes by one frame.
+
+        :param observation: (batch_size, C, H, W) percepts, None if every percept is missing
+        :param hidden: (1, batch_size, bs_size) state returned by the previous step, None at the first frame
+        :param mask: optional (batch_size,) bool tensor, True where the percept is missing
+        :return: belief, hidden with belief of shape (batch_size, bs_size)
+        """
+        if observation is None:
+            batch_size = 1 if hidden is None else hidden.size(1)
+            h = self.null_update().expand(batch_size, -1)
+        else:
+            h = self.encoder(observation)
+            if mask is not None:
+                h = torch.where(mask.view(-1, 1), self.null_update().to(h.dtype), h)
+
+        out, hidden = self.gru(h.unsqueeze(0), hidden)
+        return out[0], hidden
+
 
 class BeliefStateGenerator(nn.Module):
     def __init__(self, bs_size=BS_SIZE, n_size=N_SIZE, g_size=G_SIZE):
         super(BeliefStateGenerator, self).__init__()
+        self.n_size = n_size
         self.fc_seq = nn.Sequential(
             nn.Linear(bs_size + n_size, g_size),
             nn.ReLU(inplace=True),
@@ -133,6 +192,22 @@ class VisualDiscriminator(nn.Module):
         return x
 
 
+class MaskedMSELoss(nn.Module):
+    """MSE over the percepts selected by a mask, without gathering them.
+
+    The (ep_len, batch_size) mask is used as a weight broadcast over the remaining dimensions, so the loss equals
+    nn.MSELoss()(input[mask], target[mask]) but needs neither an index tensor nor a copy of the selected percepts.
+    """
+    def forward(self, input, target, mask):
+        squared_error = (input - target) ** 2
+        weight = mask.to(squared_error.dtype).view(mask.size() + (1,) * (input.dim() - mask.dim()))
+        squared_error = squared_error * weight
+
+        elements_per_percept = input.numel() // mask.numel()
+        n_elements = weight.sum().clamp(min=1) * elements_per_percept
+        return squared_error.sum() / n_elements
+
+
 class PAEGAN(nn.Module):
     def __init__(self):
         super(PAEGAN, self).__init__()
@@ -142,5 +217,24 @@ class PAEGAN(nn.Module):
         self.D = VisualDiscriminator()
         self.G = BeliefStateGenerator()
 
+    def expectation(self, belief):
+        """Decodes (batch_size, bs_size) belief states to the expected observations."""
+        return self.decoder(belief)
+
+    def sample(self, belief, n_samples):
+        """Decodes n_samples generator samples of every belief state to shape (n_samples, batch_size, C, H, W)."""
+        batch_size = belief.size(0)
+        belief_expanded = belief.unsqueeze(0).expand(n_samples, batch_size, -1).reshape(n_samples * batch_size, -1)
+        noise = belief.new_empty(n_samples * batch_size, self.G.n_size).normal_(0, 1)
+
+        recons = self.decoder(self.G(noise, belief_expanded))
+        return recons.view(n_samples, batch_size, *recons.size()[1:])
+
+    def channels_last(self):
+        """Switches the conv stacks (encoder, decoder and discriminator) to the channels-last memory layout."""
+        for module in (self.bs_prop.encoder, self.decoder, self.D):
+            module.to(memory_format=torch.channels_last)
+        return self
+
     def forward(self):
         return None
\ No newline at end of file
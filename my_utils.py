@@ -1,12 +1,14 @@
 import os
 import numpy as np
 import imageio
-import pandas as pd
-
-from train import EP_LEN, UNCERTAIN_PERCEPTS, GUARANTEED_PERCEPTS
+import torch
 
 FOLDERS = ['images', 'network', 'numerical', 'plots', 'page']
 
+# first percepts of every episode that are never masked
+GUARANTEED_PERCEPTS = 4
+UNCERTAIN_PERCEPTS = 4
+
 
 def make_dir_tree(parent_dir):
     for folder in FOLDERS:
@@ -15,19 +17,44 @@ def make_dir_tree(parent_dir):
             os.makedirs(new_dir)
 
 
-def mask_percepts(images, p, return_indices=False):
-    images_masked = np.copy(images)
+def sample_percept_mask(ep_len, batch_size, p, guaranteed=GUARANTEED_PERCEPTS, uncertain=UNCERTAIN_PERCEPTS,
+                        device=None, generator=None):
+    """Draws an independent removal mask for every episode of a batch.
+
+    Every percept is removed with probability p, except for the first guaranteed + U[0, uncertain) percepts of
+    each episode.
+
+    :param generator: optional torch.Generator to draw with, torch's default generator if None
+    :return: (ep_len, batch_size) bool tensor, True where the percept is removed, usable directly as a loss mask
+    """
     if p < 1.0:
-        for_removal = np.random.random(EP_LEN) < p
+        for_removal = torch.rand(ep_len, batch_size, device=device, generator=generator) < p
     else:
-        for_removal = np.ones(EP_LEN) > 0
+        for_removal = torch.ones(ep_len, batch_size, dtype=torch.bool, device=device)
+
+    clear_percepts = torch.full((batch_size,), guaranteed, dtype=torch.long, device=device)
+    if uncertain > 0:
+        clear_percepts += torch.randint(0, uncertain, (batch_size,), device=device, generator=generator)
+    steps = torch.arange(ep_len, device=device).unsqueeze(1)
+    for_removal &= steps >= clear_percepts.unsqueeze(0)
+
+    return for_removal
 
-    if UNCERTAIN_PERCEPTS > 0:
-        clear_percepts = GUARANTEED_PERCEPTS + np.random.randint(0, UNCERTAIN_PERCEPTS)
-    else:
-        clear_percepts = GUARANTEED_PERCEPTS
-    for_removal[0:clear_percepts] = False
-    images_masked[:, for_removal, ...] = 0
+
+def apply_percept_mask_(obs, mask):
+    """Zeroes masked percepts of a (ep_len, batch_size, ...) tensor in place, on whatever device it lives on."""
+    return obs.masked_fill_(mask.view(mask.size() + (1,) * (obs.dim() - 2)), 0)
+
+
+def mask_percepts(images, p, return_indices=False):
+    """Masks a numpy batch of shape (batch_size, ep_len, ...) with independent per-episode masks.
+
+    :return: masked copy of images and, if return_indices, the (batch_size, ep_len) bool removal mask
+    """
+    for_removal = sample_percept_mask(images.shape[1], images.shape[0], p).numpy().T
+
+    images_masked = np.copy(images)
+    images_masked[for_removal] = 0
 
     if return_indices:
         return images_masked, for_removal
@@ -51,131 +78,37 @@ def batch_to_sequence(batch_eps, fpath, normalise=False):
 
     imageio.mimsave(fpath, im_seq)
 
-from particle_filter import ParticleFilter
-from balls_sim import World
-from torch.autograd import Variable
-import torch
+import artifacts
+import evaluation
 import matplotlib.pyplot as plt
 
 
-def pf_multi_run_plot(net, sim_conf, fpath='ims/last_test.csv', cuda=True, runs=10, p_mask=1.0, n_particles=100, gif_no=0):
+def pf_multi_run_plot(net, sim_conf, fpath='ims/last_test.csv', runs=10, p_mask=1.0, n_particles=100, gif_no=0,
+                      seed=None, n_workers=None, batch_size=None):
+    """Runs are simulated and filtered in parallel (see evaluation.evaluate), the gifs show the last run.
+
+    :param seed: base seed of the runs, new runs on every call if None
+    :param batch_size: runs per forward pass of the network, all runs in one pass if None
+    """
     CONSISTENT_NOISE = False
-    RUN_LENGTH = 160
+    RUN_LENGTH = evaluation.RUN_LENGTH
     DURATION = 0.4
-    N_SIZE = 256
-
-    pf_loss_ar = np.zeros(RUN_LENGTH)
-    pae_loss_ar = np.zeros(RUN_LENGTH)
-
-    for _ in range(runs):
-        w = World(**sim_conf)
-
-        pf = ParticleFilter(sim_conf, n_particles=n_particles)
-
-        pos = [body.pos for body in w.bodies]
-        vel = [body.vel for body in w.bodies]
-        pf.warm_start(pos, vel=vel)
-
-        ims_percept = []
-        ims_pf_belief = []
-        ims_pf_sample = []
-
-        loss_pf = []
-        loss_sample_mse = []
-
-        masked_percepts = np.zeros(RUN_LENGTH) < 1
-        for i in range(RUN_LENGTH):
-            if i < 8 or np.random.rand() > p_mask:
-                measures = [body.pos + sim_conf['measurement_noise'] * np.random.randn(2) for body in w.bodies]
-                pf.update(measures)
-                masked_percepts[i] = False
-                pf.resample()
-            else:
-                masked_percepts[i] = True
-
-            w.run()
-            pf.predict()
-
-            percept = w.draw()
-            belief = pf.draw()[:, :, 0]
-            sample = pf.parts[np.random.randint(pf.n)].draw()
-
-            loss_pf.append(np.mean((percept - belief) ** 2))
-            loss_sample_mse.append(np.mean((percept - sample) ** 2))
-
-            ims_percept.append(percept)
-            ims_pf_belief.append(belief)
-            ims_pf_sample.append(sample)
-
-        # run predictions with the network
-        x = np.array(ims_percept)
-        x = x.reshape((1, RUN_LENGTH, 28, 28, 1))
-        x[:, masked_percepts, ...] = 0
-
-        x = x.transpose((1, 0, 4, 2, 3))
-        x = Variable(torch.FloatTensor(x))
-
-        if cuda:
-            net = net.cuda()
-            x = x.cuda()
-
-        states = net.bs_prop(x)
-
-        # create expected observations
-        obs_expectation = net.decoder(states)
-        obs_expectation = obs_expectation.view(x.size())
-
-        obs_expectation = obs_expectation.data.cpu().numpy()
-        obs_expectation = obs_expectation.reshape((RUN_LENGTH, 28, 28))
-
-        # create observation samples (constant or varying noise accross time)
-        if CONSISTENT_NOISE is True:
-            noise = Variable(torch.FloatTensor(1, N_SIZE))
-            noise.data.normal_(0, 1)
-            noise = noise.expand(RUN_LENGTH, N_SIZE)
-        else:
-            noise = Variable(torch.FloatTensor(RUN_LENGTH, N_SIZE))
-            noise.data.normal_(0, 1)
 
-        if cuda:
-            noise = noise.cuda()
+    results = evaluation.evaluate(net, sim_conf, fpath, runs=runs, seed=seed, n_workers=n_workers,
+                                  run_length=RUN_LENGTH, p_mask=p_mask, n_particles=n_particles,
+                                  consistent_noise=CONSISTENT_NOISE, batch_size=batch_size)
 
-        # states_non_ep = states.unfold(0, 1, (EP_LEN*BATCH_SIZE)//GAN_BATCH_SIZE).squeeze(-1)
+    pf_loss_ar = np.mean([r['pf_loss'] for r in results], axis=0)
+    pae_loss_ar = np.mean([r['pae_loss'] for r in results], axis=0)
 
-        pae_samples = net.G(noise, states.squeeze_(1))
-        pae_samples = net.decoder(pae_samples)
-        pae_samples = pae_samples.view(x.size())
+    last_run = results[-1]
+    ims_percept = list(last_run['percept'])
+    ims_pf_belief = list(last_run['pf_belief'])
+    ims_pf_sample = list(last_run['pf_sample'])
+    pae_ims = list(last_run['pae_belief'])
+    pae_samples_ims = list(last_run['pae_sample'])
 
-        pae_samples = pae_samples.data.cpu().numpy()
-        pae_samples = pae_samples.reshape((RUN_LENGTH, 28, 28))
-
-        pae_ims = []
-        pae_samples_ims = []
-        loss_pae = []
-        for i in range(RUN_LENGTH):
-            pae_ims.append(obs_expectation[i, ...])
-            pae_samples_ims.append(pae_samples[i, ...])
-            loss_pae.append(np.mean((ims_percept[i] - obs_expectation[i, ...]) ** 2))
-
-        pf_loss_ar += np.array(loss_pf)
-        pae_loss_ar += np.array(loss_pae)
-
-    ims_ar = np.array(ims_percept)
-    av_pixel_intensity = np.mean(ims_ar)
-    baseline_level = np.mean((ims_ar - av_pixel_intensity) ** 2)
-    baseline = np.ones(len(loss_pf)) * baseline_level
-    # print("Uninformative baseline level at {}".format(baseline_level))
-
-    pf_loss_ar /= runs
-    pae_loss_ar /= runs
-    baseline_ar = baseline
-
-    df = pd.DataFrame({'pf loss': pf_loss_ar,
-                  'pae loss': pae_loss_ar,
-                  'baseline': baseline_ar
-    })
-
-    df.to_csv(fpath)
+    baseline = np.ones(RUN_LENGTH) * evaluation.baseline_loss([r['percept'] for r in results])
 
     plt.plot(pf_loss_ar)
     plt.plot(pae_loss_ar)
@@ -228,105 +161,42 @@ def pf_multi_run_plot(net, sim_conf, fpath='ims/last_test.csv', cuda=True, runs=
         f.write(page)
 
 
-def pf_comparison(net, sim_conf, path, gif_no, cuda=True):
+def pf_comparison(net, sim_conf, path, gif_no, writer=None, seed=None):
+    """Compares PF and PAE on a single run and writes gifs, a plot and a page to path/page.
+
+    :param writer: optional artifacts.ArtifactWriter to write the files in the background
+    :param seed: seed of the compared run, a new run on every call if None
+    """
     CONSISTENT_NOISE = False
-    RUN_LENGTH = 160
+    RUN_LENGTH = evaluation.RUN_LENGTH
     N_PARTICLES = 400
     DURATION = 0.3
-    N_SIZE = 256
-
-    w = World(**sim_conf)
-
-    pf = ParticleFilter(sim_conf, n_particles=N_PARTICLES)
-
-    pos = [body.pos for body in w.bodies]
-    vel = [body.vel for body in w.bodies]
-    pf.warm_start(pos, vel=vel)
-
-    ims = []
-
-    ims_percept = []
-    ims_pf_belief = []
-    ims_pf_sample = []
-
-    loss_mse = []
-    loss_sample_mse = []
-    loss_mae = []
-
-    for i in range(RUN_LENGTH):
-        if i < 8:
-            measures = [body.pos + sim_conf['measurement_noise'] * np.random.randn(2)for body in w.bodies]
-            pf.update(measures)
-            pf.resample()
-
-        w.run()
-        pf.predict()
-
-        percept = w.draw()
-        belief = pf.draw()[:, :, 0]
-        sample = pf.parts[np.random.randint(pf.n)].draw()
-
-        loss_mse.append(np.mean((percept - belief) ** 2))
-        loss_sample_mse.append(np.mean((percept - sample) ** 2))
 
-        ims_percept.append(percept)
-        ims_pf_belief.append(belief)
-        ims_pf_sample.append(sample)
+    # the filter and the network only see the first evaluation.MEASURED_PERCEPTS percepts
+    run = evaluation.pf_run(sim_conf, seed, run_length=RUN_LENGTH, p_mask=1.0, n_particles=N_PARTICLES)
+    ims_percept = list(run['percept'])
+    ims_pf_belief = list(run['pf_belief'])
+    ims_pf_sample = list(run['pf_sample'])
+    loss_mse = run['pf_loss']
 
     # run predictions with the network
-    x = np.array(ims_percept)
-    x = x.reshape((1, RUN_LENGTH, 28, 28, 1))
-    x[:, 8:, ...] = 0
-
-    x = x.transpose((1, 0, 4, 2, 3))
-    x = Variable(torch.FloatTensor(x))
-
-    if cuda:
-        x = x.cuda()
-
-    states = net.bs_prop(x)
-
-    # create expected observations
-    obs_expectation = net.decoder(states)
-    obs_expectation = obs_expectation.view(x.size())
-
-    obs_expectation = obs_expectation.data.cpu().numpy()
-    obs_expectation = obs_expectation.reshape((RUN_LENGTH, 28, 28))
-
-    # create observation samples (constant or varying noise accross time)
-    if CONSISTENT_NOISE is True:
-        noise = Variable(torch.FloatTensor(1, N_SIZE))
-        noise.data.normal_(0, 1)
-        noise = noise.expand(RUN_LENGTH, N_SIZE)
-    else:
-        noise = Variable(torch.FloatTensor(RUN_LENGTH, N_SIZE))
-        noise.data.normal_(0, 1)
-
-    if cuda:
-        noise = noise.cuda()
-
-    # states_non_ep = states.unfold(0, 1, (EP_LEN*BATCH_SIZE)//GAN_BATCH_SIZE).squeeze(-1)
-
-    pae_samples = net.G(noise, states.squeeze_(1))
-    pae_samples = net.decoder(pae_samples)
-    pae_samples = pae_samples.view(x.size())
-
-    pae_samples = pae_samples.data.cpu().numpy()
-    pae_samples = pae_samples.reshape((RUN_LENGTH, 28, 28))
-
-    pae_ims = []
-    pae_samples_ims = []
-    loss_pae = []
-    for i in range(RUN_LENGTH):
-        pae_ims.append(obs_expectation[i, ...])
-        pae_samples_ims.append(pae_samples[i, ...])
-        loss_pae.append(np.mean((ims_percept[i] - obs_expectation[i, ...]) ** 2))
+    pae = evaluation.evaluate_batch(net, run['percept'][None], run['masked'][None],
+                                    consistent_noise=CONSISTENT_NOISE, return_images=True)
+    pae_ims = list(pae['expectation'][0, 0])
+    pae_samples_ims = list(pae['sample'][0, 0, 0])
+    loss_pae = pae['expectation_mse'][0, 0]
+
+    def write(fpath, fn, *args, **kwargs):
+        if writer is not None:
+            writer.submit(fpath, fn, fpath, *args, block=True, **kwargs)
+        else:
+            fn(fpath, *args, **kwargs)
 
-    imageio.mimsave("{}/page/{}-percept.gif".format(path, gif_no), ims_percept, duration=DURATION)
-    imageio.mimsave("{}/page/{}-pf_belief.gif".format(path, gif_no), ims_pf_belief, duration=DURATION)
-    imageio.mimsave("{}/page/{}-pf_sample.gif".format(path, gif_no), ims_pf_sample, duration=DURATION)
-    imageio.mimsave("{}/page/{}-pae_belief.gif".format(path, gif_no), pae_ims, duration=DURATION)
-    imageio.mimsave("{}/page/{}-pae_sample.gif".format(path, gif_no), pae_samples_ims, duration=DURATION)
+    write("{}/page/{}-percept.gif".format(path, gif_no), imageio.mimsave, ims_percept, duration=DURATION)
+    write("{}/page/{}-pf_belief.gif".format(path, gif_no), imageio.mimsave, ims_pf_belief, duration=DURATION)
+    write("{}/page/{}-pf_sample.gif".format(path, gif_no), imageio.mimsave, ims_pf_sample, duration=DURATION)
+    write("{}/page/{}-pae_belief.gif".format(path, gif_no), imageio.mimsave, pae_ims, duration=DURATION)
+    write("{}/page/{}-pae_sample.gif".format(path, gif_no), imageio.mimsave, pae_samples_ims, duration=DURATION)
 
     page = """
     <html>
@@ -355,8 +225,7 @@ def pf_comparison(net, sim_conf, path, gif_no, cuda=True):
     </html>
     """.format(gif_no, sim_conf)
 
-    with open("{}/page/page-{}.html".format(path, gif_no), 'w') as f:
-        f.write(page)
+    write("{}/page/page-{}.html".format(path, gif_no), artifacts.write_text, page)
 
     ims_ar = np.array(ims_percept)
     av_pixel_intensity = np.mean(ims_ar)
@@ -364,14 +233,5 @@ def pf_comparison(net, sim_conf, path, gif_no, cuda=True):
     baseline = np.ones(len(loss_mse)) * baseline_level
     print("Uninformative baseline level at {}".format(baseline_level))
 
-    plt.plot(loss_mse)
-    plt.plot(loss_pae)
-    plt.plot(baseline, 'g--')
-
-    plt.title("Image reconstruction loss vs timestep")
-    plt.ylabel("loss (MSE)")
-    plt.xlabel("timestep")
-    plt.legend(["PF", "PAE", "baseline"])
-
-    plt.savefig("{}/page/{}-plot.png".format(path, gif_no))
-    plt.close()
+    write("{}/page/{}-plot.png".format(path, gif_no), artifacts.save_loss_plot, [loss_mse, loss_pae, baseline],
+          ["PF", "PAE", "baseline"], styles=['-', '-', 'g--'])
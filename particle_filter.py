@@ -4,6 +4,8 @@ import numpy as np
 import copy
 
 import balls_sim
+import rendering
+import resampling
 from balls_sim import DEFAULT_SIM_CONFIG, WORLD_LEN
 
 
@@ -14,6 +16,21 @@ def norm_pdf(x):
     return np.exp(-x ** 2 / 2)
 
 
+def norm_logpdf(x):
+    # log of norm_pdf, same constant dropped
+    return -x ** 2 / 2
+
+
+def logsumexp(a, axis=None):
+    a_max = np.max(a, axis=axis, keepdims=True)
+    a_max[~np.isfinite(a_max)] = 0.0
+    with np.errstate(divide='ignore'):
+        out = np.log(np.sum(np.exp(a - a_max), axis=axis, keepdims=True)) + a_max
+    if axis is None:
+        return out.reshape(())[()]
+    return np.squeeze(out, axis=axis)
+
+
 class ParticleFilter(object):
     def __init__(self, sim_config=DEFAULT_SIM_CONFIG, n_particles=1000):
         self.sim_config = copy.deepcopy(DEFAULT_SIM_CONFIG)
@@ -57,26 +74,39 @@ class ParticleFilter(object):
     def update(self, measurement):
         assert len(measurement) == self.n_targets
 
+        log_likelihood = np.zeros(self.n)
         for i, part in enumerate(self.parts):
             for j, body in enumerate(part.bodies):
                 # dist = np.linalg.norm(measurement[j] - body.pos)
                 # self.w[i] *= norm_pdf(dist / (np.sqrt(np.sqrt(self.measurement_noise))))
 
                 errors_2 = (measurement[j] - body.pos)**2
-                self.w[i] *= norm_pdf(errors_2[0]/np.sqrt(self.measurement_noise)) * norm_pdf(errors_2[1]/np.sqrt(self.measurement_noise))
+                log_likelihood[i] += np.sum(norm_logpdf(errors_2/np.sqrt(self.measurement_noise)))
 
-        self.w /= np.sum(self.w)
+        # weight and normalise in log space so small measurement noise does not underflow the weights
+        with np.errstate(divide='ignore'):
+            log_w = np.log(self.w) + log_likelihood
+        self.w = np.exp(log_w - logsumexp(log_w))
 
-    def resample(self):
-        indices = np.array(range(self.n))
+    def resample(self, scheme='multinomial'):
         self.w /= np.sum(self.w)
-        samples_i = np.random.choice(indices, self.n, p=self.w)
+        samples_i = resampling.resample_indices(self.w, scheme)
+
+        # gather the compact body state instead of deep copying whole worlds
+        pos = np.array([[body.pos for body in part.bodies] for part in self.parts])[samples_i]
+        vel = np.array([[body.vel for body in part.bodies] for part in self.parts])[samples_i]
+        measured_pos = np.array([[body.measured_pos for body in part.bodies] for part in self.parts])[samples_i]
+        bounce = [[body.bounce for body in self.parts[i].bodies] for i in samples_i]
+        in_transition = [[body.in_transition for body in self.parts[i].bodies] for i in samples_i]
 
-        new_parts = []
-        for i in range(self.n):
-            new_parts.append(copy.deepcopy(self.parts[samples_i[i]]))
+        for i, part in enumerate(self.parts):
+            for j, body in enumerate(part.bodies):
+                body.pos = pos[i, j]
+                body.vel = vel[i, j]
+                body.measured_pos = measured_pos[i, j]
+                body.bounce = bounce[i][j]
+                body.in_transition = in_transition[i][j]
 
-        self.parts = new_parts
         self.w = np.ones(self.n)/self.n
 
     def get_distributions(self):
@@ -106,24 +136,180 @@ class ParticleFilter(object):
         return pos_mean, pos_std, vel_mean, vel_std
 
     def draw(self):
-        image = np.zeros((WORLD_LEN, WORLD_LEN, 1))
+        pos = np.array([[body.pos for body in part.bodies] for part in self.parts])
+        radii = np.array([[body.r for body in part.bodies] for part in self.parts])
 
-        for i, part in enumerate(self.parts):
-            part_im = np.zeros((WORLD_LEN, WORLD_LEN))
-            for body in part.bodies:
-                pos_x = body.pos[0] + self.measurement_noise * np.random.randn(1)
-                pos_y = body.pos[1] + self.measurement_noise * np.random.randn(1)
-                radius = body.r
+        image = rendering.belief_image(pos, self.w, radii, jitter=self.measurement_noise)
+        return image[:, :, None]
+
+
+class VectorParticleFilter(object):
+    """Particle filter keeping the whole particle population in arrays.
+
+    Particles are the worlds of a balls_sim.VectorWorld, so positions and velocities live in
+    (n_particles, n_bodies, 2) arrays and every step of the filter is a handful of batched numpy operations
+    instead of a python loop over balls_sim.World objects, with the same dynamics for every
+    wall_action/ball_action mode.
+
+    Weights are kept as normalised log-weights, so likelihoods from small measurement noise never underflow, and
+    update returns the effective sample size as a per-step health metric. Resampling gathers the state arrays with
+    indices from the resampling module and only happens once the effective sample size drops below
+    resample_threshold * n_particles, so steps without a measurement are free. Belief images are rendered in
+    memory-bounded chunks by the rendering module, optionally from a kernel table.
+    """
+    def __init__(self, sim_config=DEFAULT_SIM_CONFIG, n_particles=1000, resampling_scheme='systematic',
+                 resample_threshold=0.5, chunk_size=rendering.DEFAULT_CHUNK_SIZE, use_kernel_lookup=False):
+        self.sim_config = copy.deepcopy(DEFAULT_SIM_CONFIG)
+        self.sim_config.update(sim_config)
+        self.n = n_particles
+        self.resampling_scheme = resampling_scheme
+        self.resample_threshold = resample_threshold
+        self.chunk_size = chunk_size
+
+        self.n_targets = sim_config['n_bodies']
+
+        self.measurement_noise = sim_config['measurement_noise']
+
+        self.dynamics_noise = sim_config['dynamics_noise']
+
+        self.world = balls_sim.VectorWorld(self.n, **self.sim_config)
 
-                # for non rolling images simply:
-                # images[i, :, :, 0] += np.exp(-(((self.I - pos_x) ** 2 + (self.J - pos_y) ** 2) / (radii[j] ** 2)) ** 4)
+        # normalised log-weights, self.w exposes them as plain weights
+        self.log_w = np.full(self.n, -np.log(self.n))
 
-                x_dist = (np.abs(self.I - pos_x) + WORLD_LEN/2) % WORLD_LEN - WORLD_LEN/2
-                y_dist = (np.abs(self.J - pos_y) + WORLD_LEN/2) % WORLD_LEN - WORLD_LEN/2
-                body_im = np.exp(-((x_dist ** 2 + y_dist ** 2) / (radius ** 2)) ** 4)
-                part_im += body_im
+        # all bodies share one radius, so blobs can come from a precomputed table
+        self.kernel = None
+        if use_kernel_lookup:
+            self.kernel = rendering.KernelTable(self.sim_config['radius'])
+
+    @property
+    def pos(self):
+        return self.world.pos
+
+    @pos.setter
+    def pos(self, pos):
+        self.world.pos = pos
+
+    @property
+    def vel(self):
+        return self.world.vel
+
+    @vel.setter
+    def vel(self, vel):
+        self.world.vel = vel
+
+    @property
+    def radii(self):
+        return self.world.radii
+
+    def warm_start(self, pos, vel=None):
+        assert len(pos) == self.n_targets
 
-            part_im = np.clip(part_im, 0, 1)
-            image[:, :, 0] += part_im * self.w[i]
+        self.pos[...] = np.asarray(pos, dtype='float64')
+        if vel is not None:
+            self.vel[...] = np.asarray(vel, dtype='float64')
 
-        return image
+        self.add_noise(self.measurement_noise)
+
+    def add_noise(self, noise_level=0.2):
+        self.vel += noise_level * np.random.randn(*self.vel.shape)
+
+    def predict(self, dt=1.0):
+        self.world.run(dt, measure=False)
+
+    def update(self, measurement):
+        assert len(measurement) == self.n_targets
+
+        errors_2 = (np.asarray(measurement)[None, ...] - self.pos)**2
+        log_likelihood = np.sum(norm_logpdf(errors_2/np.sqrt(self.measurement_noise)).reshape(self.n, -1), axis=-1)
+
+        self.log_w += log_likelihood
+        self.log_w -= logsumexp(self.log_w)
+
+        return self.ess
+
+    @property
+    def w(self):
+        return np.exp(self.log_w)
+
+    @w.setter
+    def w(self, w):
+        with np.errstate(divide='ignore'):
+            log_w = np.log(w)
+        self.log_w = log_w - logsumexp(log_w)
+
+    @property
+    def ess(self):
+        """Effective sample size 1 / sum(w^2), computed from the normalised log-weights."""
+        return np.exp(-logsumexp(2 * self.log_w))
+
+    def resample(self, scheme=None, force=False):
+        """Resamples the population when the effective sample size is below resample_threshold * n_particles.
+
+        :param scheme: resampling scheme name, defaults to the filter's scheme
+        :param force: resample regardless of the effective sample size
+        :return: True if the particles were resampled
+        """
+        if not force and self.ess >= self.resample_threshold * self.n:
+            return False
+
+        if scheme is None:
+            scheme = self.resampling_scheme
+        samples_i = resampling.resample_indices(self.w, scheme)
+
+        self.world.take(samples_i)
+        self.log_w = np.full(self.n, -np.log(self.n))
+
+        return True
+
+    def get_distributions(self):
+        """Particle positions and velocities, (n_particles, 2) for a single target or
+        (n_particles, n_targets, 2) otherwise.
+        """
+        if self.n_targets == 1:
+            return self.pos[:, 0].copy(), self.vel[:, 0].copy()
+
+        return self.pos.copy(), self.vel.copy()
+
+    def get_stats(self):
+        """Weighted means and standard deviations of the particle positions and velocities.
+
+        Resampling only happens once the effective sample size is low, so the weights are generally not uniform.
+        """
+        poses, vels = self.get_distributions()
+        w = self.w
+
+        pos_mean = np.average(poses, axis=0, weights=w)
+        vel_mean = np.average(vels, axis=0, weights=w)
+
+        pos_std = np.sqrt(np.average((poses - pos_mean) ** 2, axis=0, weights=w))
+        vel_std = np.sqrt(np.average((vels - vel_mean) ** 2, axis=0, weights=w))
+
+        return pos_mean, pos_std, vel_mean, vel_std
+
+    def draw(self):
+        image = rendering.belief_image(self.pos, self.w, self.radii, jitter=self.measurement_noise,
+                                       chunk_size=self.chunk_size, kernel=self.kernel)
+        return image[:, :, None]
+
+    def draw_trajectory(self, poses, weights):
+        """Renders beliefs for snapshots of this filter taken over time in one batched call.
+
+        :param poses: (T, n_particles, n_bodies, 2) snapshots of self.pos
+        :param weights: (T, n_particles) snapshots of self.w
+        :return: (T, WORLD_LEN, WORLD_LEN) belief images
+        """
+        return rendering.belief_trajectory(poses, weights, self.radii, jitter=self.measurement_noise,
+                                           chunk_size=self.chunk_size, kernel=self.kernel)
+
+    def draw_sample(self, i=None):
+        """Draws the percept of a single particle, equivalent to ParticleFilter.parts[i].draw().
+
+        :param i: particle index, drawn with probability self.w if None
+        :return: (WORLD_LEN, WORLD_LEN) float32 image
+        """
+        if i is None:
+            i = resampling.multinomial(self.w, 1)[0]
+
+        pos = self.pos[i:i+1] + self.measurement_noise * np.random.randn(1, self.n_targets, 2)
+        return rendering.blob_images(pos, self.radii[i:i+1], kernel=self.kernel)[0].astype('float32')
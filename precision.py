@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Mixed precision training.
+
+fp32 runs everything in float32. bf16 autocasts the forward passes to bfloat16 on CPU or CUDA; bfloat16 keeps the
+float32 exponent range, so gradients need no loss scaling. fp16 (CUDA only) autocasts to float16 and scales the
+losses with a GradScaler so that small gradients do not underflow.
+"""
+import contextlib
+
+import torch
+
+PRECISIONS = ('fp32', 'bf16', 'fp16')
+AUTOCAST_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+class Precision(object):
+    """Autocast context and loss scaling shared by all optimisers of one training loop.
+
+    Losses go through backward() and optimisers through step(); update() is called once per training update, after
+    the last step.
+    """
+    def __init__(self, precision='fp32', use_cuda=False):
+        if precision not in PRECISIONS:
+            raise ValueError('Bad precision', precision)
+        if precision == 'fp16' and not use_cuda:
+            raise ValueError('fp16 autocast needs CUDA, use bf16 on CPU', precision)
+
+        self.precision = precision
+        self.device_type = 'cuda' if use_cuda else 'cpu'
+        self.enabled = precision != 'fp32'
+        self.scaler = torch.amp.GradScaler('cuda', enabled=precision == 'fp16')
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=AUTOCAST_DTYPES[self.precision])
+
+    def fp32(self, criterion):
+        """Wraps a criterion so that it always runs in float32 (CUDA autocast rejects BCELoss)."""
+        def criterion_fp32(input, target):
+            with torch.autocast(self.device_type, enabled=False):
+                return criterion(input.float(), target.float())
+        return criterion_fp32
+
+    def backward(self, loss):
+        # backward replays the dtypes chosen in the forward pass, autocast must not be active here
+        with torch.autocast(self.device_type, enabled=False):
+            self.scaler.scale(loss).backward()
+
+    def step(self, optimiser):
+        self.scaler.step(optimiser)
+
+    def update(self):
+        self.scaler.update()
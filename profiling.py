@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Per-phase timing of the training loop and torch profiler capture.
+
+PhaseTimer splits every update into consecutive named phases: start(name) closes the open phase and opens the next,
+so the loop is instrumented with one call per phase boundary and costs a perf_counter call each. Totals are kept
+per epoch and written as a json summary. ProfilerWindow records a torch profiler trace of a chosen update window.
+"""
+import collections
+import json
+import time
+
+import torch
+
+
+class PhaseTimer(object):
+    """Accumulates wall time of consecutive named phases.
+
+    :param sync_cuda: synchronise CUDA at every phase boundary, accurate GPU phase times at a throughput cost
+    """
+    def __init__(self, sync_cuda=False):
+        self.sync_cuda = sync_cuda
+        self.totals = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.n_updates = 0
+        self.epoch_start = time.perf_counter()
+
+        self.current = None
+        self.current_start = None
+        self.record_function = None
+
+    def start(self, name):
+        """Closes the open phase, if any, and opens the phase name."""
+        now = self._now()
+        self._close(now)
+
+        self.current = name
+        self.current_start = now
+        if profiler_active():
+            # name the phase in the profiler trace as well
+            self.record_function = torch.profiler.record_function(name)
+            self.record_function.__enter__()
+
+    def stop(self):
+        self._close(self._now())
+        self.current = None
+
+    def end_update(self):
+        self.stop()
+        self.n_updates += 1
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _close(self, now):
+        if self.record_function is not None:
+            self.record_function.__exit__(None, None, None)
+            self.record_function = None
+
+        if self.current is None:
+            return
+        self.totals[self.current] = self.totals.get(self.current, 0.0) + now - self.current_start
+        self.counts[self.current] = self.counts.get(self.current, 0) + 1
+
+    def summary(self):
+        """
+        :return: dict with the epoch 'wall_s', 'n_updates' and per phase 'total_s', 'count', 'mean_ms' per
+            occurrence and 'fraction' of the timed total
+        """
+        timed = sum(self.totals.values())
+        phases = collections.OrderedDict()
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            phases[name] = {
+                'total_s': total,
+                'count': self.counts[name],
+                'mean_ms': 1000 * total / self.counts[name],
+                'fraction': total / timed if timed > 0 else 0.0,
+            }
+
+        return {'wall_s': time.perf_counter() - self.epoch_start, 'n_updates': self.n_updates, 'phases': phases}
+
+    def write_summary(self, fpath, **fields):
+        summary = self.summary()
+        summary.update(fields)
+        with open(fpath, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def reset(self):
+        self.stop()
+        self.totals.clear()
+        self.counts.clear()
+        self.n_updates = 0
+        self.epoch_start = time.perf_counter()
+
+
+def format_summary(summary):
+    lines = ['{:>16} {:>10} {:>10} {:>8}'.format('phase', 'total [s]', 'mean [ms]', 'share')]
+    for name, phase in summary['phases'].items():
+        lines.append('{:>16} {:>10.2f} {:>10.2f} {:>7.1f}%'.format(name, phase['total_s'], phase['mean_ms'],
+                                                                100 * phase['fraction']))
+    return '\n'.join(lines)
+
+
+_active_profilers = []
+
+
+def profiler_active():
+    return len(_active_profilers) > 0
+
+
+class ProfilerWindow(object):
+    """Runs the torch profiler for n_updates updates starting at update start (counted over all epochs).
+
+    The chrome trace goes to trace_path and a table of the most expensive ops to table_path.
+    """
+    def __init__(self, start, n_updates, trace_path, table_path, use_cuda=False):
+        self.start = start
+        self.stop_at = start + n_updates
+        self.trace_path = trace_path
+        self.table_path = table_path
+        self.use_cuda = use_cuda
+        self.profiler = None
+
+    def step(self, update):
+        """Called at the start of every update with the global update index."""
+        if update == self.start and self.start < self.stop_at:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+            _active_profilers.append(self.profiler)
+
+        elif update == self.stop_at:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+
+        self.profiler.__exit__(None, None, None)
+        _active_profilers.remove(self.profiler)
+        self.profiler.export_chrome_trace(self.trace_path)
+        sort_by = 'cuda_time_total' if self.use_cuda else 'cpu_time_total'
+        with open(self.table_path, 'w') as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        print('Wrote profiler trace of updates [{}, {}) to {}'.format(self.start, self.stop_at, self.trace_path))
+        self.profiler = None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Resampling schemes for particle filters.
+
+Every scheme takes normalised particle weights and returns the indices of the particles that survive, so a filter
+resamples by gathering its state arrays with the returned indices instead of copying particle objects.
+"""
+import numpy as np
+
+
+def _normalise(w):
+    w = np.asarray(w, dtype='float64')
+    return w / np.sum(w)
+
+
+def _search(w, points):
+    cumulative = np.cumsum(w)
+    # guard against the last cumulative weight landing just under 1.0
+    cumulative[-1] = 1.0
+    return np.minimum(np.searchsorted(cumulative, points, side='right'), len(w) - 1)
+
+
+def multinomial(w, n=None):
+    """Independent draws from the weight distribution (what np.random.choice does)."""
+    w = _normalise(w)
+    if n is None:
+        n = len(w)
+    return _search(w, np.random.rand(n))
+
+
+def stratified(w, n=None):
+    """One uniform draw in each of n equal strata of [0, 1)."""
+    w = _normalise(w)
+    if n is None:
+        n = len(w)
+    return _search(w, (np.arange(n) + np.random.rand(n)) / n)
+
+
+def systematic(w, n=None):
+    """n evenly spaced points sharing a single uniform offset, lowest variance of the schemes here."""
+    w = _normalise(w)
+    if n is None:
+        n = len(w)
+    return _search(w, (np.arange(n) + np.random.rand()) / n)
+
+
+def residual(w, n=None):
+    """Keeps floor(n * w) copies of every particle deterministically and draws the remainder multinomially."""
+    w = _normalise(w)
+    if n is None:
+        n = len(w)
+
+    counts = np.floor(n * w).astype('int64')
+    indices = np.repeat(np.arange(len(w)), counts)
+
+    n_residual = n - len(indices)
+    if n_residual > 0:
+        residual_w = n * w - counts
+        indices = np.concatenate((indices, multinomial(residual_w, n_residual)))
+
+    return indices
+
+
+SCHEMES = {
+    'multinomial': multinomial,
+    'stratified': stratified,
+    'systematic': systematic,
+    'residual': residual,
+}
+
+
+def resample_indices(w, scheme='systematic', n=None):
+    """
+    :param w: particle weights, normalised here
+    :param scheme: one of SCHEMES
+    :param n: number of indices to draw, len(w) by default
+    :return: indices of the resampled particles
+    """
+    try:
+        resample_fn = SCHEMES[scheme]
+    except KeyError:
+        raise ValueError('Bad resampling scheme', scheme)
+
+    return resample_fn(w, n)
+
+
+def effective_sample_size(w):
+    """Kish effective sample size, equal to len(w) for uniform weights and 1 for a degenerate population."""
+    w = _normalise(w)
+    return 1.0 / np.sum(w ** 2)
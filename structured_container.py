@@ -1,91 +1,277 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
+import os
 import numpy as np
 import random
 import torch
 
+import columnar_record
+import rendering
 from balls_sim import WORLD_LEN
 
+# bump when the rendering changes, so stale image caches are not reused
+IMAGE_CACHE_VERSION = 1
+
+DATA_FORMATS = ('auto', 'columnar', 'manifest', 'pt')
+
+# float32 caches hold the renders exactly, float16 and uint8 quantise them to save memory
+IMAGE_CACHE_DTYPES = ('float32', 'float16', 'uint8')
+
+
+def dataset_file(data_dir, split, data_format='auto'):
+    """Path of a split ('train' or 'valid') recorded by structured_recorder.
+
+    :param data_format: 'columnar' directory, shard 'manifest', 'pt' record or 'auto' for the first of these present
+    """
+    if data_format == 'auto':
+        for candidate in DATA_FORMATS[1:]:
+            path = dataset_file(data_dir, split, candidate)
+            if columnar_record.is_columnar(path) or (candidate != 'columnar' and os.path.exists(path)):
+                return path
+        raise ValueError('No dataset found', data_dir, split)
+    elif data_format == 'columnar':
+        return os.path.join(data_dir, split)
+    elif data_format == 'pt':
+        return os.path.join(data_dir, '{}.pt'.format(split))
+    elif data_format == 'manifest':
+        return os.path.join(data_dir, '{}-manifest.json'.format(split))
+    else:
+        raise ValueError('Bad data format', data_format)
+
 
 class DataContainer(object):
-    def __init__(self, file, batch_size, ep_len_read=100, shape=((28, 28, 1))):
+    def __init__(self, file, batch_size, ep_len_read=100, shape=((28, 28, 1)), shards=None,
+                 render_chunk_size=rendering.DEFAULT_CHUNK_SIZE):
         self.file = file
         self.ep_len_read = ep_len_read
         self.batch_size = batch_size
+        self.shards = shards
+        self.render_chunk_size = render_chunk_size
 
         self.sim_config = None
 
         self.n_episodes = None
         self.record = None
+        self.columns = None
         self.images = None
         self.images_populated = False
 
         self.load_record(file)
+        self.set_ep_len(ep_len_read)
 
         self.im_shape = shape
 
-        space = np.linspace(0.5, WORLD_LEN-0.5, WORLD_LEN)
-        self.I, self.J = np.meshgrid(space, space)
-
     def set_ep_len(self, ep_len):
+        if ep_len > self.columns['poses'].shape[1]:
+            raise ValueError('Episodes shorter than ep_len', self.columns['poses'].shape[1], ep_len)
         self.ep_len_read = ep_len
 
     def load_record(self, file):
         print("Loading {}".format(file))
-        self.record = torch.load(file)
+        if columnar_record.is_columnar(file):
+            # memory-mapped, episodes are read on demand
+            header, self.columns = columnar_record.load_columnar(file)
+            self.record = {'n_episodes': header['n_episodes'], 'sim_config': header['sim_config']}
+        elif file.endswith('.json'):
+            self.record, self.columns = self.load_manifest(file, self.shards)
+        else:
+            # records hold numpy scalars, which the default weights_only unpickler rejects
+            self.record = torch.load(file, weights_only=False)
+            # keep full precision so images match the ones rendered from the episode dicts, then drop the dicts
+            self.columns = columnar_record.episodes_to_arrays(self.record.pop('episodes'), dtype='float64')
+
         self.n_episodes = self.record['n_episodes']
         self.sim_config = self.record['sim_config']
 
-    def populate_images(self):
+    @staticmethod
+    def load_manifest(file, shards=None):
+        """Loads a sharded record written by structured_recorder.Record.run_sharded.
+
+        Shards are columnar records whose memory-mapped columns are concatenated; the pickled shards of older
+        recordings are converted on load.
+
+        :param file: path to the manifest
+        :param shards: indices of the shards to load, all listed shards if None
+        :return: (record, columns) with the record dict and the column arrays of the selected shards
+        """
+        with open(file) as f:
+            manifest = json.load(f)
+
+        entries = manifest['shards']
+        if shards is not None:
+            by_index = {entry['index']: entry for entry in entries}
+            entries = [by_index[i] for i in shards]
+
+        shard_columns = []
+        for entry in entries:
+            path = os.path.join(os.path.dirname(file), entry['file'])
+            if columnar_record.is_columnar(path):
+                shard_columns.append(columnar_record.load_columnar(path)[1])
+            else:
+                shard = torch.load(path, weights_only=False)
+                shard_columns.append(columnar_record.episodes_to_arrays(shard['episodes'], dtype='float64'))
+
+        if len(shard_columns) == 1:
+            # a single shard stays memory-mapped
+            columns = shard_columns[0]
+        else:
+            columns = {column: np.concatenate([c[column] for c in shard_columns]) for column in shard_columns[0]}
+
+        record = {'n_episodes': len(columns['radii']), 'sim_config': manifest['sim_config']}
+        return record, columns
+
+    def populate_images(self, cache_dir=None, cache_dtype='float32'):
+        """Renders every episode, or memory-maps the images from a cache rendered by an earlier run.
+
+        :param cache_dir: folder of the image cache, images are kept in RAM as float64 if None
+        :param cache_dtype: storage of cached images, one of IMAGE_CACHE_DTYPES
+        """
         if self.images_populated:
             return
+        elif cache_dir is not None:
+            self.images = self.load_image_cache(cache_dir, cache_dtype)
         else:
             self.images = np.zeros((self.n_episodes, self.ep_len_read) + self.im_shape)
-            for i, episode in enumerate(self.record['episodes']):
-                self.images[i, ...] = self.episode2images(episode)
+            for chunk, images in self.episodes2images_chunked(np.arange(self.n_episodes)):
+                self.images[chunk, ...] = images
+        self.images_populated = True
 
     def destroy_images(self):
         self.images = None
+        self.images_populated = False
+
+    def dataset_files(self):
+        if columnar_record.is_columnar(self.file):
+            return [os.path.join(self.file, name) for name in sorted(os.listdir(self.file))]
+        elif self.file.endswith('.json'):
+            with open(self.file) as f:
+                entries = json.load(f)['shards']
+            if self.shards is not None:
+                entries = [entry for entry in entries if entry['index'] in self.shards]
+            files = [self.file]
+            for entry in entries:
+                path = os.path.join(os.path.dirname(self.file), entry['file'])
+                if columnar_record.is_columnar(path):
+                    files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+                else:
+                    files.append(path)
+            return files
+        else:
+            return [self.file]
+
+    def image_cache_key(self, cache_dtype):
+        """Hash of the dataset contents and of everything that affects the rendered images."""
+        key = hashlib.sha1()
+        for path in self.dataset_files():
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    key.update(block)
+
+        render_params = {
+            'version': IMAGE_CACHE_VERSION,
+            'shards': self.shards,
+            'ep_len_read': self.ep_len_read,
+            'im_shape': self.im_shape,
+            'world_len': WORLD_LEN,
+            'dtype': cache_dtype,
+        }
+        key.update(json.dumps(render_params, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def load_image_cache(self, cache_dir, cache_dtype='float32'):
+        """Memory-maps the cached images of this dataset, rendering them into the cache first if missing.
+
+        The cache is written to a temporary file and renamed when complete, so processes sharing the cache
+        never read a partial file and all map the same copy through the page cache.
+        """
+        if cache_dtype not in IMAGE_CACHE_DTYPES:
+            raise ValueError('Bad cache_dtype', cache_dtype)
+
+        path = os.path.join(cache_dir, 'images-{}.npy'.format(self.image_cache_key(cache_dtype)))
+        if not os.path.exists(path):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            print("Rendering image cache {}".format(path))
+
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            shape = (self.n_episodes, self.ep_len_read) + self.im_shape
+            images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=cache_dtype, shape=shape)
+            for chunk, chunk_images in self.episodes2images_chunked(np.arange(self.n_episodes)):
+                if cache_dtype == 'uint8':
+                    chunk_images = np.rint(chunk_images * 255)
+                images[chunk, ...] = chunk_images
+            images.flush()
+            del images
+            os.replace(tmp_path, path)
+
+        print("Mapping {} image cache {}".format(cache_dtype, path))
+        return np.load(path, mmap_mode='r')
+
+    def images_to_float(self, images):
+        images = images.astype('float')
+        if self.images.dtype == np.uint8:
+            images /= 255
+        return images
 
     def get_n_random_structured_episodes(self, n):
-        random_eps = random.sample(self.record['episodes'], n)
+        random_eps = columnar_record.arrays_to_episodes(self.columns, self.get_n_random_indices(n))
         return random_eps
 
-    def episode2images(self, episode, noisy=False):
-        radii = episode['radii']
-        ts = episode['t_list']
-
-        images = np.zeros((self.ep_len_read,) + self.im_shape)
-
-        for i in range(self.ep_len_read):
-            t = ts[i]
-            if not noisy:
-                points = t['poses']
-            else:
-                points = t['measures']
-
-            for j, point in enumerate(points):
-                pos_x = point[0]
-                pos_y = point[1]
+    def get_n_random_indices(self, n, random_state=None):
+        if random_state is not None:
+            return list(random_state.choice(self.n_episodes, n, replace=False))
+        return random.sample(range(self.n_episodes), n)
 
-                # for non rolling images simply:
-                # images[i, :, :, 0] += np.exp(-(((self.I - pos_x) ** 2 + (self.J - pos_y) ** 2) / (radii[j] ** 2)) ** 4)
-
-                x_dist = (np.abs(self.I - pos_x) + WORLD_LEN/2) % WORLD_LEN - WORLD_LEN/2
-                y_dist = (np.abs(self.J - pos_y) + WORLD_LEN/2) % WORLD_LEN - WORLD_LEN/2
-                images[i, :, :, 0] += np.exp(-((x_dist ** 2 + y_dist ** 2) / (radii[j] ** 2)) ** 4)
-
-        images = np.clip(images, 0, 1)
-        return images
-
-    def get_n_random_episodes(self, n):
+    def episode2images(self, episode, noisy=False):
+        arrays = columnar_record.episodes_to_arrays([episode], dtype='float64')
+        points = arrays['measures'][0] if noisy else arrays['poses'][0]
+        return self.positions2images(points, arrays['radii'][0])
+
+    def positions2images(self, points, radii):
+        """
+        :param points: (T, n_bodies, 2) positions, at least ep_len_read steps
+        :param radii: (n_bodies,) radii
+        :return: (ep_len_read, *im_shape) images
+        """
+        return self.episodes2images(np.asarray(points)[None], np.asarray(radii)[None])[0]
+
+    def episodes2images(self, points, radii):
+        """Renders the first ep_len_read frames of many episodes in one batched call.
+
+        :param points: (n_episodes, T, n_bodies, 2) clean poses or noisy measures
+        :param radii: (n_episodes, n_bodies) radii
+        :return: (n_episodes, ep_len_read, *im_shape) images, identical to drawing the frames one by one
+        """
+        points = np.asarray(points[:, :self.ep_len_read], dtype='float64')
+        n_episodes, ep_len = points.shape[:2]
+        radii = np.broadcast_to(np.asarray(radii, dtype='float64')[:, None, :], points.shape[:-1])
+
+        frames = rendering.blob_images(points.reshape((n_episodes * ep_len,) + points.shape[2:]),
+                                       radii.reshape((n_episodes * ep_len,) + radii.shape[2:]),
+                                       chunk_size=self.render_chunk_size)
+        return frames.reshape((n_episodes, ep_len) + self.im_shape)
+
+    def episodes2images_chunked(self, indices, noisy=False):
+        """Yields (indices, images) for the episodes at indices, render_chunk_size frames at a time."""
+        column = 'measures' if noisy else 'poses'
+        ep_chunk = max(1, self.render_chunk_size // self.ep_len_read)
+        for start in range(0, len(indices), ep_chunk):
+            chunk = indices[start:start + ep_chunk]
+            yield chunk, self.episodes2images(self.columns[column][chunk], self.columns['radii'][chunk])
+
+    def get_n_random_episodes(self, n, random_state=None):
+        """
+        :param random_state: optional np.random.RandomState to draw the episodes with, the global generators if None
+        """
         if self.images is None:
-            eps = self.get_n_random_structured_episodes(n)
-            images = np.array([self.episode2images(ep) for ep in eps])
+            eps = self.get_n_random_indices(n, random_state)
+            images = self.episodes2images(self.columns['poses'][eps], self.columns['radii'][eps])
 
         else:
-            ep_rolls = np.random.randint(0, self.n_episodes, n)
-            images = self.images[ep_rolls, ...].astype('float')
+            ep_rolls = (random_state or np.random).randint(0, self.n_episodes, n)
+            images = self.images_to_float(self.images[ep_rolls, ...])
 
             return images
 
@@ -97,33 +283,24 @@ class DataContainer(object):
         ep_rolls = np.random.randint(0, self.n_episodes, n)
         im_rolls = np.random.randint(0, self.ep_len_read, n)
 
-        images = self.images[ep_rolls, im_rolls, ...].astype('float')
+        images = self.images_to_float(self.images[ep_rolls, im_rolls, ...])
         return images
 
     def get_n_random_episodes_full(self, n=1):
-        eps = self.get_n_random_structured_episodes(n)
-        images = np.array([self.episode2images(ep) for ep in eps])
-
-        eps_poses = []
-        eps_vels = []
-        for ep in eps:
-            poses = []
-            vels = []
-            for t in ep['t_list']:
-                poses.append(t['poses'])
-                vels.append(t['vels'])
-
-            eps_poses.append(poses)
-            eps_vels.append(vels)
-
-        # poses = np.array(eps_poses)
+        eps = self.get_n_random_indices(n)
+        images = self.episodes2images(self.columns['poses'][eps], self.columns['radii'][eps])
+
+        # (n, T, n_bodies, 2) arrays
+        eps_poses = np.array(self.columns['poses'][eps])
+        eps_vels = np.array(self.columns['vels'][eps])
+
         return images, eps_poses, eps_vels
 
     def get_episode(self):
         return self.get_n_random_episodes(1)[0]
 
-    def get_batch_episodes(self):
-        return self.get_n_random_episodes(self.batch_size)
+    def get_batch_episodes(self, random_state=None):
+        return self.get_n_random_episodes(self.batch_size, random_state)
 
         # def generate_ae(self):
         #     while True:
@@ -3,6 +3,9 @@
 Records structured data from bouncing balls simulation
 """
 import balls_sim
+import columnar_record
+import json
+import multiprocessing
 import os
 import numpy as np
 import torch
@@ -29,10 +32,55 @@ record_config = {
     # 'n_episodes': 2000,
     'episode_length': 100,
     'folder': 'generated-data/',
-    'random_seed': 15
+    'random_seed': 15,
+    # 'columnar' writes memory-mappable column arrays, 'pt' a pickled record
+    'format': 'columnar',
+    # set shard_size to record in parallel shards listed by a manifest
+    'shard_size': None,
+    'n_workers': None,
 }
 
 
+def simulate_episodes(sim_config, n_episodes, ep_length, random_state=None):
+    """Simulates n_episodes at once with balls_sim.VectorWorld.
+
+    :return: dict of column arrays, 'poses', 'vels' and 'measures' of shape (n_episodes, ep_length, n_bodies, 2)
+        and 'radii' and 'masses' of shape (n_episodes, n_bodies)
+    """
+    world = balls_sim.VectorWorld(n_episodes, random_state=random_state, **sim_config)
+
+    poses = np.zeros((n_episodes, ep_length) + world.pos.shape[1:])
+    vels = np.zeros((n_episodes, ep_length) + world.vel.shape[1:])
+    measures = np.zeros((n_episodes, ep_length) + world.measured_pos.shape[1:])
+    for t in range(ep_length):
+        world.run()
+        poses[:, t] = world.pos
+        vels[:, t] = world.vel
+        measures[:, t] = world.measured_pos
+
+    return {'poses': poses, 'vels': vels, 'measures': measures,
+            'radii': np.copy(world.radii), 'masses': np.copy(world.masses)}
+
+
+def record_episodes(sim_config, n_episodes, ep_length, random_state=None):
+    """Simulates n_episodes at once with balls_sim.VectorWorld.
+
+    :return: list of episode dicts with 'radii', 'masses' and a 't_list' of 'poses', 'vels' and 'measures'
+    """
+    arrays = simulate_episodes(sim_config, n_episodes, ep_length, random_state=random_state)
+    return columnar_record.arrays_to_episodes(arrays)
+
+
+def _record_shard(task):
+    sim_config, n_episodes, ep_length, seed, index, filepath = task
+
+    arrays = simulate_episodes(sim_config, n_episodes, ep_length, random_state=seed)
+    arrays = {column: array.astype('float32') for column, array in arrays.items()}
+    columnar_record.write_columnar(filepath, arrays, sim_config, seed=seed)
+
+    return {'index': index, 'file': os.path.basename(filepath), 'n_episodes': n_episodes, 'seed': seed}
+
+
 class Record(object):
     def __init__(self, **kwargs):
         self.record = {}
@@ -45,63 +93,118 @@ class Record(object):
         filename_sim_config = '{}.conf'.format(kwargs['train'])
         self.filepath_sim_config = os.path.join(kwargs['folder'], filename_sim_config)
 
+        filename_manifest = '{}-manifest.json'.format(kwargs['train'])
+        self.filepath_manifest = os.path.join(kwargs['folder'], filename_manifest)
+
         self.n_episodes = kwargs['n_episodes']
         self.ep_length = kwargs['episode_length']
         self.all_eps = []
+        self.arrays = None
 
         self.record.update({'episodes': self.all_eps})
 
         if kwargs['train'] == 'train':
-            np.random.seed(kwargs['random_seed'])
+            self.seed = kwargs['random_seed']
         else:
-            np.random.seed(kwargs['random_seed'] + 1000)
+            self.seed = kwargs['random_seed'] + 1000
+        np.random.seed(self.seed)
 
     def run(self):
         sim_config = self.record['sim_config']
-
-        for i_ep in range(self.n_episodes):
-            # print(i_ep)
-            ep_dict = {}
-            t_list = []
-            ep_dict.update({'t_list': t_list})
-
-            world = balls_sim.World(**sim_config)
-
-            # save constants for the episode
-            radii = [np.copy(body.r) for body in world.bodies]
-            masses = [np.copy(body.m) for body in world.bodies]
-            ep_dict.update({'radii': radii})
-            ep_dict.update({'masses': masses})
-
-            for t in range(self.ep_length):
-                world.run()
-                t_dict = {}
-                poses = [np.copy(body.pos) for body in world.bodies]
-                vels = [body.vel for body in world.bodies]
-                measures = [np.copy(body.measured_pos) for body in world.bodies]
-
-                t_dict.update({'poses': poses})
-                t_dict.update({'vels': vels})
-                t_dict.update({'measures': measures})
-                t_list.append(t_dict)
-
-            self.all_eps.append(ep_dict)
+        self.arrays = simulate_episodes(sim_config, self.n_episodes, self.ep_length)
+        self.all_eps.extend(columnar_record.arrays_to_episodes(self.arrays))
+
+    def run_sharded(self, n_workers=None, shard_size=None):
+        """Records the episodes in fixed-size shards spread over a process pool.
+
+        Every shard gets its own seed derived from random_seed and is written to disk by its worker as soon as it
+        is done, so memory stays bounded and a crash only loses the shards in flight. The manifest listing the
+        finished shards is rewritten after every shard and can be loaded by DataContainer.
+
+        :param n_workers: size of the process pool, all cores if None
+        :param shard_size: episodes per shard
+        :return: the manifest dict
+        """
+        if n_workers is None:
+            n_workers = self.record.get('n_workers') or multiprocessing.cpu_count()
+        if shard_size is None:
+            shard_size = self.record.get('shard_size') or 100
+
+        n_shards = int(np.ceil(self.n_episodes / shard_size))
+        shard_seeds = np.random.SeedSequence(self.seed).generate_state(n_shards)
+
+        tasks = []
+        for i_shard in range(n_shards):
+            n_eps = min(shard_size, self.n_episodes - i_shard * shard_size)
+            filename = '{}-shard-{:04d}'.format(self.record['train'], i_shard)
+            tasks.append((self.record['sim_config'], n_eps, self.ep_length, int(shard_seeds[i_shard]),
+                          i_shard, os.path.join(self.record['folder'], filename)))
+
+        manifest = {
+            'sim_type': self.record['sim_type'],
+            'train': self.record['train'],
+            'sim_config': self.record['sim_config'],
+            'episode_length': self.ep_length,
+            'n_episodes': 0,
+            'random_seed': self.record['random_seed'],
+            'shards': [],
+        }
+
+        torch.save(self.record['sim_config'], self.filepath_sim_config)
+
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            for shard in pool.imap_unordered(_record_shard, tasks):
+                manifest['shards'].append(shard)
+                manifest['shards'].sort(key=lambda x: x['index'])
+                manifest['n_episodes'] += shard['n_episodes']
+                self.write_manifest(manifest)
+        finally:
+            pool.close()
+            pool.join()
+
+        return manifest
+
+    def write_manifest(self, manifest):
+        # write then rename, so readers never see a half written manifest
+        tmp_path = self.filepath_manifest + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.filepath_manifest)
 
     def write(self, filepath=None):
         if filepath is None:
             filepath = self.filepath
         # data = np.array(self.ep_list)
         print('Writing', filepath)
-        torch.save(self.record, open(filepath, 'wb'))
-        torch.save(simulation_config, open(self.filepath_sim_config, 'wb'))
+        torch.save(self.record, filepath)
+        torch.save(simulation_config, self.filepath_sim_config)
+
+    def write_columnar(self, path=None):
+        """Writes the episodes of the last run in the columnar format as float32 arrays."""
+        if path is None:
+            path = os.path.join(self.record['folder'], self.record['train'])
+        print('Writing', path)
+        arrays = {column: array.astype('float32') for column, array in self.arrays.items()}
+        columnar_record.write_columnar(path, arrays, self.record['sim_config'],
+                                       sim_type=self.record['sim_type'],
+                                       train=self.record['train'],
+                                       random_seed=self.record['random_seed'])
+        torch.save(self.record['sim_config'], self.filepath_sim_config)
 
 
 
 if __name__ == '__main__':
     rec = Record(**record_config)
 
-    rec.run()
-    rec.write()
+    if record_config['shard_size']:
+        rec.run_sharded()
+    else:
+        rec.run()
+        if record_config['format'] == 'columnar':
+            rec.write_columnar()
+        else:
+            rec.write()
 
 
 
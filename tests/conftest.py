@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import columnar_record
+import structured_recorder
+
+
+@pytest.fixture
+def columnar_dir(tmp_path):
+    """Small columnar record of 16 episodes of 30 steps."""
+    path = str(tmp_path / 'record')
+    arrays = structured_recorder.simulate_episodes(structured_recorder.simulation_config, 16, 30, random_state=0)
+    columnar_record.write_columnar(path, arrays, structured_recorder.simulation_config)
+    return path
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import balls_sim
+import bench_collisions
+
+
+@pytest.mark.parametrize('wall_action', ['pass', 'bounce'])
+@pytest.mark.parametrize('n_bodies', [2, 30])
+def test_grid_matches_brute(n_bodies, wall_action):
+    _, _, same = bench_collisions.bench(n_bodies, 100, wall_action)
+    assert same
+
+
+def test_auto_broadphase():
+    config = dict(bench_collisions.bench_config)
+    config['n_bodies'] = balls_sim.GRID_MIN_BODIES - 1
+    assert balls_sim.World(**config).broadphase == 'brute'
+    config['n_bodies'] = balls_sim.GRID_MIN_BODIES
+    assert balls_sim.World(**config).broadphase == 'grid'
+
+
+@pytest.mark.parametrize('wall_action', ['pass', 'bounce', 'mixed'])
+@pytest.mark.parametrize('ball_action', ['pass', 'bounce'])
+def test_vector_world_matches_world(wall_action, ball_action):
+    """Started from the same states, VectorWorld steps every world like World.run."""
+    config = dict(balls_sim.DEFAULT_SIM_CONFIG, n_bodies=3, radius=4.0, wall_action=wall_action,
+                  ball_action=ball_action, dynamics_noise=0.0)
+    np.random.seed(0)
+    worlds = [balls_sim.World(**config) for _ in range(6)]
+    vector_world = balls_sim.VectorWorld(len(worlds), **config)
+    vector_world.pos[...] = [[body.pos for body in world.bodies] for world in worlds]
+    vector_world.vel[...] = [[body.vel for body in world.bodies] for world in worlds]
+    vector_world.bounce[...] = [[body.bounce for body in world.bodies] for world in worlds]
+
+    for _ in range(50):
+        vector_world.run()
+        for world in worlds:
+            world.run()
+
+    np.testing.assert_allclose(vector_world.pos, [[body.pos for body in world.bodies] for world in worlds])
+    np.testing.assert_allclose(vector_world.vel, [[body.vel for body in world.bodies] for world in worlds])
+    np.testing.assert_allclose(vector_world.measured_pos,
+                               [[body.measured_pos for body in world.bodies] for world in worlds])
@@ -0,0 +1,36 @@
+import torch
+
+import batch_loader
+from structured_container import DataContainer
+
+
+def draw(container, seed, n_workers, n_batches=6):
+    loader = batch_loader.PrefetchingLoader(container.get_batch_episodes, 0.9, n_workers=n_workers, seed=seed)
+    try:
+        batches = []
+        for _ in range(n_batches):
+            masked, batch, mask = loader.get()
+            batches.append((masked.clone(), batch.clone(), mask.clone()))
+        return batches
+    finally:
+        loader.close()
+
+
+def same(first, second):
+    return all(torch.equal(a, b) for x, y in zip(first, second) for a, b in zip(x, y))
+
+
+def test_seeded_batches_repeat(columnar_dir):
+    container = DataContainer(columnar_dir, batch_size=3, ep_len_read=20)
+    container.populate_images()
+
+    for n_workers in (0, 1, 3):
+        assert same(draw(container, 5, n_workers), draw(container, 5, n_workers))
+    assert not same(draw(container, 5, 3), draw(container, 6, 3))
+
+
+def test_masks_match_batches(columnar_dir):
+    container = DataContainer(columnar_dir, batch_size=3, ep_len_read=20)
+    for masked, batch, mask in draw(container, 0, 2):
+        assert masked.shape == (20, 3, 1, 28, 28)
+        assert torch.equal(masked, batch.masked_fill(mask.view(20, 3, 1, 1, 1), 0))
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+
+import torch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import distributed
+import models
+from test_train import data_dir, train  # noqa: F401, the fixture is shared
+
+TORCHRUN = (sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node', '2')
+
+
+def run_replicas():
+    """Trains differently initialised replicas on different data, as in train.py, and checks they stay equal."""
+    import torch.distributed as dist
+
+    rank, world_size = distributed.init(1)
+    torch.manual_seed(distributed.rank_seed(0))
+    net = models.PAEGAN()
+    distributed.broadcast_module(net)
+
+    optimiser_pae = torch.optim.Adam(list(net.bs_prop.parameters()) + list(net.decoder.parameters()), lr=3e-4)
+    optimiser_d = torch.optim.Adam(net.D.parameters(), lr=2e-4)
+    for update in range(3):
+        net.zero_grad()
+        obs = torch.rand(6, 2, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)
+        states = net.bs_prop(obs)
+        err_pae = ((net.decoder(states.view(12, -1)).view(obs.size()) - obs) ** 2).mean()
+        if update % 2 == 0:
+            err_d = net.D(obs.view(12, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)).mean()
+            err_d.backward()
+            distributed.average_gradients(optimiser_d)
+            optimiser_d.step()
+        err_pae.backward()
+        distributed.average_gradients(optimiser_pae)
+        optimiser_pae.step()
+
+    distributed.average_buffers(net)
+    for key, tensor in net.state_dict().items():
+        gathered = [torch.zeros_like(tensor) for _ in range(world_size)]
+        dist.all_gather(gathered, tensor)
+        assert all(torch.equal(gathered[0], other) for other in gathered), key
+    distributed.close()
+
+
+def test_replicas_stay_equal():
+    result = subprocess.run(list(TORCHRUN) + [os.path.abspath(__file__)], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+    assert result.returncode == 0, result.stdout
+
+
+def test_torchrun_training(data_dir, tmp_path):  # noqa: F811
+    timing = train(data_dir, tmp_path, '--training_stage', 'visual-sampler', launcher=TORCHRUN)
+    assert timing['world_size'] == 2
+
+
+if __name__ == '__main__':
+    run_replicas()
@@ -0,0 +1,29 @@
+import numpy as np
+
+import evaluation
+import structured_recorder
+
+
+def test_pf_run_keeps_caller_random_state():
+    sim_conf = structured_recorder.simulation_config
+
+    np.random.seed(1)
+    expected = np.random.rand(3)
+
+    for seed in (5, None):
+        np.random.seed(1)
+        evaluation.pf_run(sim_conf, seed, run_length=12, n_particles=20)
+        np.testing.assert_array_equal(np.random.rand(3), expected)
+
+
+def test_pf_run_seeded():
+    sim_conf = structured_recorder.simulation_config
+    first = evaluation.pf_run(sim_conf, 5, run_length=12, p_mask=0.5, n_particles=20)
+    second = evaluation.pf_run(sim_conf, 5, run_length=12, p_mask=0.5, n_particles=20)
+    for key in first:
+        np.testing.assert_array_equal(first[key], second[key])
+
+    serial = evaluation.pf_runs(sim_conf, 2, seed=3, n_workers=0, run_length=12, n_particles=20)
+    pooled = evaluation.pf_runs(sim_conf, 2, seed=3, n_workers=2, run_length=12, n_particles=20)
+    for a, b in zip(serial, pooled):
+        np.testing.assert_array_equal(a['pf_loss'], b['pf_loss'])
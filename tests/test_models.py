@@ -0,0 +1,73 @@
+import torch
+
+import models
+
+
+def test_null_update_follows_autocast():
+    torch.manual_seed(0)
+    bs_prop = models.BeliefStatePropagator()
+    belief = torch.rand(3, models.BS_SIZE)
+
+    with torch.no_grad():
+        expected = bs_prop.rollout(belief, 4)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            assert bs_prop.null_update().dtype == torch.bfloat16
+            bs_prop.rollout(belief, 4)
+
+        # the bf16 encoding cached under autocast is not reused outside of it
+        assert bs_prop.null_update().dtype == torch.float32
+        torch.testing.assert_close(bs_prop.rollout(belief, 4), expected)
+        belief_step, _ = bs_prop.step(hidden=belief.unsqueeze(0))
+        torch.testing.assert_close(belief_step, expected[0])
+
+
+def test_null_update_recomputed_after_step():
+    bs_prop = models.BeliefStatePropagator()
+    before = bs_prop.null_update().clone()
+    with torch.no_grad():
+        for p in bs_prop.encoder.parameters():
+            p.add_(0.1)
+    assert not torch.equal(bs_prop.null_update(), before)
+
+
+def test_bptt_chunks():
+    torch.manual_seed(0)
+    net = models.PAEGAN()
+    obs = torch.rand(12, 2, models.IM_CHANNELS, models.IM_WIDTH, models.IM_WIDTH)
+
+    def loss(states, target):
+        return ((net.decoder(states.reshape(-1, models.BS_SIZE)).view(target.size()) - target) ** 2).mean()
+
+    full_loss = loss(net.bs_prop(obs), obs)
+    full_loss.backward()
+    full_grads = [p.grad.clone() for p in net.bs_prop.parameters()]
+
+    # a single window over the episode is plain backprop
+    net.zero_grad()
+    hidden = None
+    window_loss = loss(net.bs_prop(obs[:12], hidden), obs)
+    window_loss.backward()
+    assert torch.equal(window_loss, full_loss)
+    for p, grad in zip(net.bs_prop.parameters(), full_grads):
+        torch.testing.assert_close(p.grad, grad, rtol=0, atol=0)
+
+    # shorter windows carrying the detached state see the same belief states
+    with torch.no_grad():
+        states = []
+        for start in range(0, 12, 4):
+            chunk = net.bs_prop(obs[start:start + 4], hidden)
+            hidden = chunk[-1:].detach()
+            states.append(chunk)
+        torch.testing.assert_close(torch.cat(states), net.bs_prop(obs))
+
+
+def test_masked_mse_matches_gather():
+    torch.manual_seed(0)
+    input = torch.rand(6, 3, models.IM_CHANNELS, 4, 4)
+    target = torch.rand(6, 3, models.IM_CHANNELS, 4, 4)
+    mask = torch.rand(6, 3) < 0.5
+
+    torch.testing.assert_close(models.MaskedMSELoss()(input, target, mask),
+                               torch.nn.MSELoss()(input[mask], target[mask]))
+    # an empty mask gives a zero loss instead of nan
+    assert models.MaskedMSELoss()(input, target, torch.zeros_like(mask)).item() == 0.0
@@ -0,0 +1,91 @@
+import numpy as np
+
+import particle_filter
+import resampling
+import structured_recorder
+from particle_filter import ParticleFilter, VectorParticleFilter
+
+
+def weighted_filter():
+    sim_config = dict(structured_recorder.simulation_config, measurement_noise=0.0)
+    pf = VectorParticleFilter(sim_config, n_particles=10)
+    pf.pos[:, 0] = np.arange(10)[:, None] + 5.0
+    pf.vel[:, 0] = np.arange(10)[:, None] * 0.1
+    w = np.zeros(10)
+    w[2], w[7] = 0.75, 0.25
+    pf.w = w
+    return pf
+
+
+def test_stats_are_weighted():
+    pf = weighted_filter()
+    pos_mean, pos_std, vel_mean, vel_std = pf.get_stats()
+
+    np.testing.assert_allclose(pos_mean, [0.75 * 7 + 0.25 * 12] * 2)
+    np.testing.assert_allclose(pos_std, [np.sqrt(0.75 * 0.25) * 5] * 2)
+    np.testing.assert_allclose(vel_mean, [0.75 * 0.2 + 0.25 * 0.7] * 2)
+    np.testing.assert_allclose(vel_std, [np.sqrt(0.75 * 0.25) * 0.5] * 2)
+
+
+def test_samples_follow_weights():
+    pf = weighted_filter()
+    np.random.seed(0)
+    particles = {2: pf.draw_sample(2), 7: pf.draw_sample(7)}
+
+    counts = {2: 0, 7: 0}
+    for _ in range(400):
+        sample = pf.draw_sample()
+        matches = [i for i, image in particles.items() if np.array_equal(sample, image)]
+        assert len(matches) == 1
+        counts[matches[0]] += 1
+
+    assert 0.65 < counts[2] / 400.0 < 0.85
+
+
+def test_vector_filter_matches_particle_filter():
+    """Filtering the same particles, the vectorised filter tracks the loop over World objects."""
+    sim_config = dict(structured_recorder.simulation_config, wall_action='bounce', dynamics_noise=0.0)
+    np.random.seed(0)
+    loop_pf = ParticleFilter(sim_config, n_particles=50)
+    vector_pf = VectorParticleFilter(sim_config, n_particles=50)
+    vector_pf.pos[...] = [[body.pos for body in part.bodies] for part in loop_pf.parts]
+    vector_pf.vel[...] = [[body.vel for body in part.bodies] for part in loop_pf.parts]
+
+    for measurement in ([[10.0, 12.0]], [[11.0, 13.0]], [[12.5, 13.5]]):
+        loop_pf.predict()
+        vector_pf.predict()
+        loop_pf.update(measurement)
+        vector_pf.update(measurement)
+        np.testing.assert_allclose(vector_pf.w, loop_pf.w, rtol=1e-9, atol=1e-300)
+
+    np.random.seed(1)
+    loop_pf.resample('systematic')
+    np.random.seed(1)
+    vector_pf.resample('systematic', force=True)
+    np.testing.assert_allclose(vector_pf.pos, [[body.pos for body in part.bodies] for part in loop_pf.parts])
+    np.testing.assert_allclose(vector_pf.vel, [[body.vel for body in part.bodies] for part in loop_pf.parts])
+
+    for loop_stat, vector_stat in zip(loop_pf.get_stats(), vector_pf.get_stats()):
+        np.testing.assert_allclose(vector_stat, loop_stat, atol=1e-9)
+
+    np.random.seed(2)
+    loop_image = loop_pf.draw()
+    np.random.seed(2)
+    np.testing.assert_allclose(vector_pf.draw(), loop_image)
+
+
+def test_ess_from_log_weights():
+    """The effective sample size is 1 / sum(w^2), also for log-weights whose plain weights underflow."""
+    sim_config = dict(structured_recorder.simulation_config)
+    pf = VectorParticleFilter(sim_config, n_particles=20)
+    assert np.isclose(pf.ess, 20)
+
+    w = np.random.RandomState(0).rand(20)
+    pf.w = w
+    np.testing.assert_allclose(pf.ess, 1.0 / np.sum((w / w.sum()) ** 2))
+    np.testing.assert_allclose(pf.ess, resampling.effective_sample_size(w))
+
+    # exp(-2000) underflows to 0.0 in float64, the log-weights still hold a 3:1 ratio
+    log_w = np.array([-2000.0, -2000.0 - np.log(3)] + [-np.inf] * 18)
+    pf.log_w = log_w - particle_filter.logsumexp(log_w)
+    np.testing.assert_allclose(pf.ess, 1.0 / (0.75 ** 2 + 0.25 ** 2))
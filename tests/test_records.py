@@ -0,0 +1,75 @@
+import numpy as np
+
+import columnar_record
+import structured_container
+import structured_recorder
+from structured_container import DataContainer
+
+
+def record(folder, split='train', n_episodes=10, episode_length=12):
+    return structured_recorder.Record(sim_type='test', sim_config=structured_recorder.simulation_config, train=split,
+                                      n_episodes=n_episodes, episode_length=episode_length, folder=str(folder),
+                                      random_seed=3)
+
+
+def test_sharded_round_trip(tmp_path):
+    rec = record(tmp_path)
+    manifest = rec.run_sharded(n_workers=2, shard_size=4)
+    assert [shard['n_episodes'] for shard in manifest['shards']] == [4, 4, 2]
+    assert all(columnar_record.is_columnar(str(tmp_path / shard['file'])) for shard in manifest['shards'])
+
+    container = DataContainer(rec.filepath_manifest, batch_size=2, ep_len_read=12, shards=[0, 2])
+    assert container.n_episodes == 6
+    assert container.columns['poses'].shape == (6, 12, 1, 2)
+
+    # the selected shards, in order, as loaded from the manifest
+    full = DataContainer(rec.filepath_manifest, batch_size=2, ep_len_read=12)
+    np.testing.assert_array_equal(container.columns['poses'][:4], full.columns['poses'][:4])
+    np.testing.assert_array_equal(container.columns['poses'][4:], full.columns['poses'][8:])
+
+    # a single shard is served from its memory map
+    single = DataContainer(rec.filepath_manifest, batch_size=2, ep_len_read=12, shards=[1])
+    assert isinstance(single.columns['poses'], np.memmap)
+    np.testing.assert_array_equal(single.columns['poses'], full.columns['poses'][4:8])
+
+
+def test_convert_recorded_pt(tmp_path):
+    rec = record(tmp_path)
+    rec.run()
+    rec.write()
+
+    columnar_path = str(tmp_path / 'train')
+    columnar_record.convert(rec.filepath, columnar_path)
+    header, arrays = columnar_record.load_columnar(columnar_path)
+    assert header['n_episodes'] == 10 and header['train'] == 'train'
+    assert arrays['poses'].dtype == np.float32
+
+    pt_container = DataContainer(rec.filepath, batch_size=2, ep_len_read=12)
+    for column, array in arrays.items():
+        np.testing.assert_allclose(array, pt_container.columns[column], rtol=1e-6)
+
+
+def test_dataset_file_prefers_columnar(tmp_path):
+    rec = record(tmp_path)
+    rec.run()
+    rec.write()
+    assert structured_container.dataset_file(str(tmp_path), 'train') == rec.filepath
+
+    rec.write_columnar()
+    path = structured_container.dataset_file(str(tmp_path), 'train')
+    assert path == str(tmp_path / 'train')
+    assert DataContainer(path, batch_size=2, ep_len_read=12).n_episodes == 10
+
+
+def test_default_image_cache_matches_renders(tmp_path):
+    rec = record(tmp_path)
+    rec.run()
+    rec.write_columnar()
+
+    rendered = DataContainer(str(tmp_path / 'train'), batch_size=2, ep_len_read=12)
+    rendered.populate_images()
+    cached = DataContainer(str(tmp_path / 'train'), batch_size=2, ep_len_read=12)
+    cached.populate_images(cache_dir=str(tmp_path / 'image_cache'))
+
+    assert cached.images.dtype == np.float32
+    np.testing.assert_allclose(cached.images_to_float(cached.images), rendered.images, atol=1e-6)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import resampling
+
+WEIGHTS = np.array([0.05, 0.3, 0.0, 0.45, 0.2])
+
+
+@pytest.mark.parametrize('scheme', sorted(resampling.SCHEMES))
+def test_unbiased(scheme):
+    """Every scheme keeps each particle n * w times on average."""
+    np.random.seed(0)
+    n = 20
+    counts = np.zeros(len(WEIGHTS))
+    for _ in range(2000):
+        indices = resampling.resample_indices(WEIGHTS, scheme, n)
+        assert len(indices) == n
+        counts += np.bincount(indices, minlength=len(WEIGHTS))
+
+    np.testing.assert_allclose(counts / 2000, n * WEIGHTS, atol=0.15)
+    assert counts[2] == 0
+
+
+@pytest.mark.parametrize('scheme, low, high', [
+    ('systematic', 0, 0),
+    ('stratified', 1, 1),
+    ('residual', 0, None),
+])
+def test_count_bounds(scheme, low, high):
+    """Systematic counts are floor or ceil of n * w, stratified ones within one more, residual ones never below the
+    floor.
+    """
+    np.random.seed(1)
+    n = 10
+    for _ in range(200):
+        w = np.random.rand(8)
+        w /= w.sum()
+        counts = np.bincount(resampling.resample_indices(w, scheme, n), minlength=len(w))
+        assert np.all(counts >= np.floor(n * w) - low)
+        if high is not None:
+            assert np.all(counts <= np.ceil(n * w) + high)
+
+
+def test_bad_scheme():
+    with pytest.raises(ValueError):
+        resampling.resample_indices(WEIGHTS, 'bad')
@@ -0,0 +1,83 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import autotune
+import models
+import structured_recorder
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data')
+    for split in ('train', 'valid'):
+        rec = structured_recorder.Record(sim_type='test', sim_config=structured_recorder.simulation_config,
+                                         train=split, n_episodes=12, episode_length=40, folder=str(path),
+                                         random_seed=1)
+        rec.run()
+        rec.write_columnar()
+    return str(path)
+
+
+def train(data_dir, output_dir, *args, launcher=(sys.executable,)):
+    """Runs an epoch of 3 updates of train.py on CPU and returns the timing summary of the epoch."""
+    # train.py only lays out output folders it creates
+    output_dir = os.path.join(str(output_dir), 'output')
+    command = list(launcher) + [os.path.join(REPO_DIR, 'train.py'), '--data_dir', data_dir,
+                                '--output_dir', output_dir, '--cuda', '0', '--epochs', '0',
+                                '--updates_per_epoch', '3', '--ep_len', '20', '--pae_batch_size', '2',
+                                '--gan_batch_size', '8', '--prefetch_workers', '1', '--seed', '0'] + list(args)
+    result = subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, timeout=600)
+    assert result.returncode == 0, result.stdout
+
+    assert os.path.isfile(os.path.join(output_dir, 'network', 'paegan_epoch_0.pth'))
+    with open(os.path.join(output_dir, 'numerical', 'timing_epoch_0.json')) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('stage', ['pae', 'visual-sampler', 'future-sampler'])
+def test_training_stages(data_dir, tmp_path, stage):
+    timing = train(data_dir, tmp_path, '--training_stage', stage)
+    assert timing['n_updates'] == 3
+    assert 'forward' in timing['phases']
+
+
+@pytest.mark.parametrize('args', [
+    ['--bptt_window', '5'],
+    ['--precision', 'bf16', '--channels_last', '1'],
+    ['--compare_with_pf', '1'],
+    ['--memory_budget', '200'],
+    ['--image_cache', '0', '--prefetch_workers', '0'],
+])
+def test_training_options(data_dir, tmp_path, args):
+    train(data_dir, tmp_path, '--training_stage', 'pae', *args)
+
+
+def test_full_bptt_window_matches_unwindowed(data_dir, tmp_path):
+    """A backprop window spanning the whole episode trains exactly like whole-episode backprop."""
+    for name, args in (('full', []), ('window', ['--bptt_window', '20'])):
+        train(data_dir, tmp_path / name, '--training_stage', 'pae', '--prefetch_workers', '2', *args)
+
+    full = torch.load(str(tmp_path / 'full' / 'output' / 'network' / 'paegan_epoch_0.pth'))
+    window = torch.load(str(tmp_path / 'window' / 'output' / 'network' / 'paegan_epoch_0.pth'))
+    for key in full:
+        assert torch.equal(full[key], window[key]), key
+
+
+def test_memory_budget_keeps_seeded_init(data_dir, tmp_path):
+    """Auto-tuning the batch size trains like passing the tuned batch size, from the same seeded initialisation."""
+    batch_size = autotune.auto_batch_size(models.PAEGAN(), 20, 200 * 2 ** 20)
+    train(data_dir, tmp_path / 'budget', '--training_stage', 'pae', '--memory_budget', '200')
+    train(data_dir, tmp_path / 'explicit', '--training_stage', 'pae', '--pae_batch_size', str(batch_size))
+
+    budget = torch.load(str(tmp_path / 'budget' / 'output' / 'network' / 'paegan_epoch_0.pth'))
+    explicit = torch.load(str(tmp_path / 'explicit' / 'output' / 'network' / 'paegan_epoch_0.pth'))
+    for key in budget:
+        assert torch.equal(budget[key], explicit[key]), key
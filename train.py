@@ -3,14 +3,22 @@
 import tqdm
 import argparse
 import os
+import random
 import numpy as np
 
 import torch
 import torch.optim as optim
-import torchvision.utils as vutils
 from torch.autograd import Variable
 
+import artifacts
+import autotune
+import batch_loader
+import compiled
+import distributed
 import my_utils
+import precision
+import profiling
+import structured_container
 from structured_container import DataContainer
 from models import *
 import models
@@ -26,8 +34,6 @@ N_STEPS_AHEAD = 4
 
 BALLS_OBS_SHAPE = (1, 28, 28)
 
-GUARANTEED_PERCEPTS = 4
-UNCERTAIN_PERCEPTS = 4
 P_NO_OBS_VALID = 1.0
 
 if __name__ == "__main__":
@@ -42,6 +48,12 @@ if __name__ == "__main__":
                         help="Type of the dataset.")
     parser.add_argument('--data_dir', type=str,
                         help="Folder with the data")
+    parser.add_argument('--data_format', default='auto', type=str,
+                        choices=structured_container.DATA_FORMATS,
+                        help="How the train and valid splits in data_dir are stored: memory-mapped columnar "
+                             "directories, shard manifests or .pt records; auto picks the first one present.")
+    parser.add_argument('--shards', type=int, nargs='+',
+                        help="Indices of the training shards to load from the manifest, all shards if not given.")
     parser.add_argument('--start_from_checkpoint', type=int,
                         help="Use network that was trained already")
     parser.add_argument('--epochs', default=10, type=int,
@@ -51,6 +63,21 @@ if __name__ == "__main__":
     parser.add_argument('--training_stage', type=str,
                         choices=['pae', 'paegan-sampler', 'visual-sampler', 'averager', 'future-sampler'],
                         help="Different training modes enable training of different parts of the network")
+    parser.add_argument('--pae_batch_size', default=PAE_BATCH_SIZE, type=int,
+                        help="Episodes per update.")
+    parser.add_argument('--gan_batch_size', default=GAN_BATCH_SIZE, type=int,
+                        help="Frames drawn per update for the discriminator and generator.")
+    parser.add_argument('--averaging_batch_size', default=AVERAGING_BATCH_SIZE, type=int,
+                        help="Generator samples averaged per belief state.")
+    parser.add_argument('--ep_len', default=EP_LEN, type=int,
+                        help="Length of the training episodes.")
+    parser.add_argument('--bptt_window', default=0, type=int,
+                        help="If > 0, truncated backprop through time: every episode is streamed in chunks of this "
+                             "many frames, one update per chunk, carrying the detached belief state between chunks. "
+                             "Must divide ep_len. 0 backpropagates through whole episodes.")
+    parser.add_argument('--memory_budget', default=0, type=float,
+                        help="If > 0, memory in MB an update may use; pae_batch_size becomes the largest batch that "
+                             "fits (estimated from the activations saved for backward).")
     parser.add_argument('--p_mask', default=0.99, type=float,
                         help="What fraction of input observations is masked? eg 0.6")
     parser.add_argument('--av_loss', default=AVERAGING_FUTURE_ERROR_MULTIPLIER, type=float,
@@ -65,6 +92,38 @@ if __name__ == "__main__":
     parser.add_argument('--cuda', default=1, type=int,
                         choices=[0, 1],
                         help="Should CUDA be used?")
+    parser.add_argument('--seed', type=int,
+                        help="Seed of the network initialisation, batches, masks and noise; random if not given. "
+                             "Batches only repeat for the same number of prefetch_workers.")
+    parser.add_argument('--prefetch_workers', default=2, type=int,
+                        help="Threads preparing batches in the background, 0 prepares them synchronously.")
+    parser.add_argument('--image_cache', default=1, type=int,
+                        choices=[0, 1],
+                        help="Should rendered images be cached (memory-mapped) in data_dir/image_cache?")
+    parser.add_argument('--image_cache_dtype', default='float32', type=str,
+                        choices=structured_container.IMAGE_CACHE_DTYPES,
+                        help="Storage of cached images, float16 and uint8 quantise the renders to save memory.")
+    parser.add_argument('--precision', default='fp32', type=str,
+                        choices=precision.PRECISIONS,
+                        help="Autocast precision of the forward passes, fp16 needs CUDA.")
+    parser.add_argument('--channels_last', default=0, type=int,
+                        choices=[0, 1],
+                        help="Should the conv stacks use the channels-last memory layout?")
+    parser.add_argument('--compile', default=0, type=int,
+                        choices=[0, 1],
+                        help="Should bs_prop, decoder and G run as compiled graphs (checked against eager mode)?")
+    parser.add_argument('--compile_cache', type=str,
+                        help="Folder caching compiled artifacts between runs, output_dir/compile_cache if not given.")
+    parser.add_argument('--profile_start', default=0, type=int,
+                        help="Update (counted over all epochs) at which the torch profiler starts recording.")
+    parser.add_argument('--profile_updates', default=0, type=int,
+                        help="How many updates the torch profiler records, 0 disables it.")
+    parser.add_argument('--sync_timing', default=0, type=int,
+                        choices=[0, 1],
+                        help="Synchronise CUDA at phase boundaries for exact phase timings (slower).")
+    parser.add_argument('--n_threads', default=0, type=int,
+                        help="Torch threads per rank when launched with torchrun for data-parallel CPU training, "
+                             "0 splits the cores evenly between the ranks.")
 
     parser.print_help()
     args = parser.parse_args()
@@ -79,6 +138,11 @@ if __name__ == "__main__":
     use_cuda = bool(args.cuda)
     compare_with_pf = bool(args.compare_with_pf)
     reward_only_masked = bool(args.reward_only_masked)
+    ep_len = args.ep_len
+    bptt_window = args.bptt_window if args.bptt_window > 0 else ep_len
+    pae_batch_size = args.pae_batch_size
+    gan_batch_size = args.gan_batch_size
+    averaging_batch_size = args.averaging_batch_size
     train_d_every_n_updates = 1
 
     train_pae_switch = False
@@ -105,7 +169,39 @@ if __name__ == "__main__":
     if use_cuda:
         assert torch.cuda.is_available() is True
 
-    if not os.path.exists(args.output_dir):
+    # data-parallel training when launched with torchrun: every rank samples its own batches, gradients are averaged
+    rank, world_size = distributed.init(args.n_threads)
+    is_main = rank == 0
+    seed = args.seed
+    if world_size > 1:
+        if use_cuda:
+            raise ValueError('Data-parallel training runs on CPU, use --cuda 0', world_size)
+        seed = distributed.rank_seed(args.seed)
+        print("Rank {} of {}, seed {}, {} threads".format(rank, world_size, seed, torch.get_num_threads()))
+
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+    if ep_len % bptt_window != 0:
+        raise ValueError('bptt_window must divide ep_len', bptt_window, ep_len)
+
+    if args.memory_budget > 0:
+        # backprop only spans a window, so that is what the activations scale with; the probe network must not
+        # draw from the seeded stream the real one is initialised from
+        with torch.random.fork_rng(devices=[]):
+            pae_batch_size = autotune.auto_batch_size(PAEGAN(), bptt_window, args.memory_budget * 2 ** 20)
+        print("Auto-tuned pae_batch_size to {} for a {} MB budget".format(pae_batch_size, args.memory_budget))
+
+    # D and G draw their frames without replacement from the chunk of a batch
+    if (train_d_switch or train_g_switch) and gan_batch_size > bptt_window * pae_batch_size:
+        raise ValueError('gan_batch_size larger than the frames of a batch', gan_batch_size,
+                         bptt_window * pae_batch_size)
+
+    mixed_precision = precision.Precision(args.precision, use_cuda)
+
+    if is_main and not os.path.exists(args.output_dir):
         my_utils.make_dir_tree(args.output_dir)
 
     # prepare data
@@ -114,18 +210,31 @@ if __name__ == "__main__":
     train_getter = None
     valid_getter = None
     if args.dataset_type == 'balls':
-        sim_config = torch.load('{}/train.conf'.format(args.data_dir))
         obs_shape = BALLS_OBS_SHAPE
 
-        train_container = DataContainer('{}/train.pt'.format(args.data_dir), batch_size=PAE_BATCH_SIZE)
-        valid_container = DataContainer('{}/valid.pt'.format(args.data_dir), batch_size=PAE_BATCH_SIZE)
-        sim_config = torch.load(open('{}/train.conf'.format(args.data_dir), 'rb'))
-
-        train_container.populate_images()
-        valid_container.populate_images()
-
-        train_getter = train_container.get_batch_episodes
-        valid_getter = valid_container.get_batch_episodes
+        train_file = structured_container.dataset_file(args.data_dir, 'train', args.data_format)
+        valid_file = structured_container.dataset_file(args.data_dir, 'valid', args.data_format)
+        if args.shards is not None and not train_file.endswith('.json'):
+            raise ValueError('Shards can only be selected from a manifest', train_file)
+
+        train_container = DataContainer(train_file, batch_size=pae_batch_size, ep_len_read=ep_len,
+                                        shards=args.shards)
+        valid_container = DataContainer(valid_file, batch_size=pae_batch_size, ep_len_read=ep_len)
+        sim_config = train_container.sim_config
+
+        image_cache_dir = '{}/image_cache'.format(args.data_dir) if args.image_cache else None
+        with distributed.main_rank_first():
+            train_container.populate_images(cache_dir=image_cache_dir, cache_dtype=args.image_cache_dtype)
+            valid_container.populate_images(cache_dir=image_cache_dir, cache_dtype=args.image_cache_dtype)
+
+        # the loaders draw with their own generators
+        train_getter = batch_loader.PrefetchingLoader(train_container.get_batch_episodes, p_mask,
+                                                      n_workers=args.prefetch_workers, pin_memory=use_cuda,
+                                                      seed=None if seed is None else [seed, 0])
+        valid_getter = batch_loader.PrefetchingLoader(valid_container.get_batch_episodes, p_mask,
+                                                      n_workers=min(1, args.prefetch_workers), queue_size=1,
+                                                      pin_memory=use_cuda,
+                                                      seed=None if seed is None else [seed, 1])
 
     else:
         raise ValueError('Failed to load data. Wrong dataset type {}'.format(args.dataset_type))
@@ -156,42 +265,59 @@ if __name__ == "__main__":
         print("Using CUDA.")
         net = net.cuda()
         criterion_pae = nn.MSELoss().cuda()
+        criterion_pae_masked = MaskedMSELoss().cuda()
         criterion_gan = nn.BCELoss().cuda()
         # criterion_gan = nn.MSELoss().cuda()
         criterion_gen_averaged = nn.MSELoss().cuda()
 
-        obs_in = Variable(torch.FloatTensor(EP_LEN, PAE_BATCH_SIZE, *BALLS_OBS_SHAPE).cuda())
-        obs_out = Variable(torch.FloatTensor(EP_LEN, PAE_BATCH_SIZE, *BALLS_OBS_SHAPE).cuda())
+        episode_in = Variable(torch.FloatTensor(ep_len, pae_batch_size, *BALLS_OBS_SHAPE).cuda())
+        episode_out = Variable(torch.FloatTensor(ep_len, pae_batch_size, *BALLS_OBS_SHAPE).cuda())
+        episode_mask = Variable(torch.FloatTensor(ep_len, pae_batch_size).cuda())
 
-        averaging_noise = Variable(torch.FloatTensor(AVERAGING_BATCH_SIZE, noise_size).cuda())
-        g_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, noise_size).cuda())
+        averaging_noise = Variable(torch.FloatTensor(averaging_batch_size, noise_size).cuda())
+        g_noise = Variable(torch.FloatTensor(gan_batch_size, noise_size).cuda())
 
-        fixed_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, noise_size).normal_(0, 1).cuda())
-        fixed_bs_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, bs_size).uniform_(-1, 1).cuda())
-        fake_labels = Variable(torch.FloatTensor(GAN_BATCH_SIZE, 1).cuda())
-        real_labels = Variable(torch.FloatTensor(GAN_BATCH_SIZE, 1).cuda())
-        null_observation = Variable(torch.FloatTensor(1, *BALLS_OBS_SHAPE).cuda())
+        fixed_noise = Variable(torch.FloatTensor(gan_batch_size, noise_size).normal_(0, 1).cuda())
+        fixed_bs_noise = Variable(torch.FloatTensor(gan_batch_size, bs_size).uniform_(-1, 1).cuda())
+        fake_labels = Variable(torch.FloatTensor(gan_batch_size, 1).cuda())
+        real_labels = Variable(torch.FloatTensor(gan_batch_size, 1).cuda())
     else:
         print("Not using CUDA.")
         net.cpu()
         criterion_pae = nn.MSELoss()
+        criterion_pae_masked = MaskedMSELoss()
         criterion_gan = nn.BCELoss()
         # criterion_gan = nn.MSELoss()
         criterion_gen_averaged = nn.MSELoss()
 
-        obs_in = Variable(torch.FloatTensor(EP_LEN, PAE_BATCH_SIZE, *BALLS_OBS_SHAPE))
-        obs_out = Variable(torch.FloatTensor(EP_LEN, PAE_BATCH_SIZE, *BALLS_OBS_SHAPE))
+        episode_in = Variable(torch.FloatTensor(ep_len, pae_batch_size, *BALLS_OBS_SHAPE))
+        episode_out = Variable(torch.FloatTensor(ep_len, pae_batch_size, *BALLS_OBS_SHAPE))
+        episode_mask = Variable(torch.FloatTensor(ep_len, pae_batch_size))
 
-        averaging_noise = Variable(torch.FloatTensor(AVERAGING_BATCH_SIZE, noise_size))
-        g_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, noise_size))
+        averaging_noise = Variable(torch.FloatTensor(averaging_batch_size, noise_size))
+        g_noise = Variable(torch.FloatTensor(gan_batch_size, noise_size))
 
-        fixed_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, noise_size).normal_(0, 1))
-        fixed_bs_noise = Variable(torch.FloatTensor(GAN_BATCH_SIZE, bs_size).uniform_(-1, 1))
-        fake_labels = Variable(torch.FloatTensor(GAN_BATCH_SIZE, 1))
-        real_labels = Variable(torch.FloatTensor(GAN_BATCH_SIZE, 1))
-        null_observation = Variable(torch.FloatTensor(1, *BALLS_OBS_SHAPE))
+        fixed_noise = Variable(torch.FloatTensor(gan_batch_size, noise_size).normal_(0, 1))
+        fixed_bs_noise = Variable(torch.FloatTensor(gan_batch_size, bs_size).uniform_(-1, 1))
+        fake_labels = Variable(torch.FloatTensor(gan_batch_size, 1))
+        real_labels = Variable(torch.FloatTensor(gan_batch_size, 1))
 
-    null_observation.data.fill_(0)
+    criterion_gan = mixed_precision.fp32(criterion_gan)
+
+    if world_size > 1:
+        # replicas start from the same weights and stay equal through averaged gradients
+        distributed.broadcast_module(net)
+
+    if args.channels_last:
+        net.channels_last()
+
+    if args.compile:
+        compile_cache = args.compile_cache or '{}/compile_cache'.format(output_dir)
+        compile_errors = compiled.compile_paegan(net, bptt_window, pae_batch_size, cache_dir=compile_cache)
+        print('Compiled modules, max abs error against eager mode: {}'.format(compile_errors))
+
+    # images and gifs are encoded and written in the background
+    artifact_writer = artifacts.ArtifactWriter()
 
     # optimisers
     optimiser_pae = optim.Adam([{'params': net.bs_prop.parameters()},
@@ -200,249 +326,296 @@ if __name__ == "__main__":
     optimiser_g = optim.Adam(net.G.parameters(), lr=0.0002)
     optimiser_d = optim.Adam(net.D.parameters(), lr=0.0002)
 
+    # per-phase timing, summarised in output_dir/numerical after every epoch
+    timer = profiling.PhaseTimer(sync_cuda=use_cuda and bool(args.sync_timing))
+    profiler_window = profiling.ProfilerWindow(args.profile_start, args.profile_updates if is_main else 0,
+                                               '{}/numerical/profile_trace.json'.format(output_dir),
+                                               '{}/numerical/profile_ops.txt'.format(output_dir), use_cuda=use_cuda)
+    global_update = 0
+
+    # truncated backprop: the chunk of the streamed episodes starts at frame chunk_start and continues from the
+    # belief state bptt_hidden that closed the previous chunk
+    chunk_start = 0
+    bptt_hidden = None
+
     # start training
     epoch_report = {}
     until_epoch = current_epoch + n_epochs + 1
     for current_epoch in range(current_epoch, until_epoch):
 
-        bar = tqdm.trange(updates_per_epoch)
+        bar = tqdm.trange(updates_per_epoch, disable=not is_main)
         epoch_report['epoch'] = '[{}/{}]'.format(current_epoch, until_epoch)
 
         for update in bar:
+            profiler_window.step(global_update)
+            global_update += 1
+
+            timer.start('data')
             net.zero_grad()
             losses = []
 
-            batch = train_getter()
-            masked, masked_indices = my_utils.mask_percepts(batch, p=p_mask, return_indices=True)
-
-            batch = batch.transpose((1, 0, 4, 2, 3))
-            masked = masked.transpose((1, 0, 4, 2, 3))
-
-            batch = torch.FloatTensor(batch)
-            masked = torch.FloatTensor(masked)
-
-            obs_in.data.copy_(masked)
-            obs_out.data.copy_(batch)
-
-            # generate beliefs states
-            # _ep means tensor has shape (ep_len, batch_size, *obs_shape)
-            # _nonep means tensor has shape (ep_len * batch_size, *obs_shape)
-            states_ep = net.bs_prop(obs_in)
-            states_nonep = states_ep.view(EP_LEN * PAE_BATCH_SIZE, -1)
-
-            obs_expectation = None
-            if train_av_switch and not train_pae_switch:
-                obs_expectation = net.decoder(states_nonep).view(obs_in.size())
-
-            elif train_pae_switch is True:
-                obs_expectation = net.decoder(states_nonep).view(obs_in.size())
-                if reward_only_masked:
-                    masked_indices = torch.ByteTensor(masked_indices.astype('int')).nonzero()
-                    if use_cuda:
-                        masked_indices = masked_indices.cuda()
-                    err_pae = criterion_pae(obs_expectation[masked_indices, :, ...], obs_out[masked_indices, :, ...])
-                    # err_pae_full = 0.05 * criterion_pae(obs_expectation, obs_out)
-                    # losses.append(err_pae_full)
-                else:
-                    err_pae = criterion_pae(obs_expectation, obs_out)
-                losses.append(err_pae)
-                epoch_report['pae train loss'] = err_pae.data[0]
-
-            if train_d_switch is True and update % train_d_every_n_updates == 0:
-                real_labels.data.fill_(real_label)
-                fake_labels.data.fill_(fake_label)
-
-                obs_out_nonep = obs_out.view(EP_LEN * PAE_BATCH_SIZE,
-                                             obs_out.size(2), obs_out.size(3), obs_out.size(4))
-                # draw real observations for D training
-                draw = np.random.choice(EP_LEN * PAE_BATCH_SIZE, size=GAN_BATCH_SIZE, replace=False)
-                obs_d = obs_out_nonep[draw, ...]
-
-                # draw states for D training
-                draw = np.random.choice(EP_LEN * PAE_BATCH_SIZE, size=GAN_BATCH_SIZE, replace=False)
-                states_d = states_nonep[draw, ...]
-
-                # train discriminator with real data
-                out_d_real = net.D(obs_d).view(GAN_BATCH_SIZE, 1)
-                # print("out_d_real", out_d_real)
-                err_d_real = criterion_gan(out_d_real, real_labels)
-
-                # train discriminator with fake data
-                g_noise.data.normal_(0, 1)
-                state_sample = net.G(g_noise, states_d)
-                obs_sample = net.decoder(state_sample)
-                out_d_fake = net.D(obs_sample.detach()).view(GAN_BATCH_SIZE, 1)
-                # print("out_d_fake", out_d_fake)
-                err_d_fake = criterion_gan(out_d_fake, fake_labels)
-
-                err_d = (err_d_fake + err_d_real) / 2
-                # losses.append(err_d)
-
-                err_d.backward()
-                optimiser_d.step()
-
-                epoch_report['d loss'] = err_d.data[0]
-
-                if update == 0:
-                    vutils.save_image(obs_d.data,
-                                      '{}/images/real_samples.png'.format(output_dir),
-                                      normalize=True)
-
-            if train_g_switch is True:
-                # train generator using discriminator
-                # draw states for G training
-                draw = np.random.choice(EP_LEN * PAE_BATCH_SIZE, size=GAN_BATCH_SIZE, replace=False)
-                states_g = states_nonep[draw, ...]
-
-                g_noise.data.normal_(0, 1)
-                state_sample = net.G(g_noise, states_g.detach())
-                obs_sample = net.decoder(state_sample)
-
-                out_d_g = net.D(obs_sample).view(GAN_BATCH_SIZE, 1)
-                # print("out_d_g", out_d_g)
-                err_g = criterion_gan(out_d_g, real_labels)
-                losses.append(err_g)
-
-                epoch_report['g loss'] = err_g.data[0]
-
-                if update % 100 == 0:
-                    state_sample = net.G(fixed_noise, states_g)
+            if chunk_start == 0:
+                # batches arrive masked and in (ep_len, batch_size, *obs_shape) layout
+                masked, batch, masked_indices = train_getter.get()
+
+                episode_in.data.copy_(masked, non_blocking=True)
+                episode_out.data.copy_(batch, non_blocking=True)
+                episode_mask.data.copy_(masked_indices, non_blocking=True)
+                bptt_hidden = None
+
+            # the whole episodes unless training with truncated backprop
+            obs_in = episode_in[chunk_start:chunk_start + bptt_window]
+            obs_out = episode_out[chunk_start:chunk_start + bptt_window]
+            percept_mask = episode_mask[chunk_start:chunk_start + bptt_window]
+
+            timer.start('forward')
+            with mixed_precision.autocast():
+                # generate beliefs states
+                # _ep means tensor has shape (bptt_window, batch_size, *obs_shape)
+                # _nonep means tensor has shape (bptt_window * batch_size, *obs_shape)
+                states_ep = net.bs_prop(obs_in, bptt_hidden)
+                bptt_hidden = states_ep[-1:].detach()
+                states_nonep = states_ep.view(bptt_window * pae_batch_size, -1)
+
+                obs_expectation = None
+                if train_av_switch and not train_pae_switch:
+                    obs_expectation = net.decoder(states_nonep).view(obs_in.size())
+
+                elif train_pae_switch is True:
+                    obs_expectation = net.decoder(states_nonep).view(obs_in.size())
+                    if reward_only_masked:
+                        # (bptt_window, batch_size) per-episode mask weights the masked percepts
+                        err_pae = criterion_pae_masked(obs_expectation, obs_out, percept_mask)
+                        # err_pae_full = 0.05 * criterion_pae(obs_expectation, obs_out)
+                        # losses.append(err_pae_full)
+                    else:
+                        err_pae = criterion_pae(obs_expectation, obs_out)
+                    losses.append(err_pae)
+                    epoch_report['pae train loss'] = err_pae.item()
+
+                if train_d_switch is True and update % train_d_every_n_updates == 0:
+                    timer.start('d update')
+                    real_labels.data.fill_(real_label)
+                    fake_labels.data.fill_(fake_label)
+
+                    obs_out_nonep = obs_out.view(bptt_window * pae_batch_size,
+                                                 obs_out.size(2), obs_out.size(3), obs_out.size(4))
+                    # draw real observations for D training
+                    draw = np.random.choice(bptt_window * pae_batch_size, size=gan_batch_size, replace=False)
+                    obs_d = obs_out_nonep[draw, ...]
+
+                    # draw states for D training
+                    draw = np.random.choice(bptt_window * pae_batch_size, size=gan_batch_size, replace=False)
+                    states_d = states_nonep[draw, ...]
+
+                    # train discriminator with real data
+                    out_d_real = net.D(obs_d).view(gan_batch_size, 1)
+                    # print("out_d_real", out_d_real)
+                    err_d_real = criterion_gan(out_d_real, real_labels)
+
+                    # train discriminator with fake data
+                    g_noise.data.normal_(0, 1)
+                    state_sample = net.G(g_noise, states_d)
+                    obs_sample = net.decoder(state_sample)
+                    out_d_fake = net.D(obs_sample.detach()).view(gan_batch_size, 1)
+                    # print("out_d_fake", out_d_fake)
+                    err_d_fake = criterion_gan(out_d_fake, fake_labels)
+
+                    err_d = (err_d_fake + err_d_real) / 2
+                    # losses.append(err_d)
+
+                    mixed_precision.backward(err_d)
+                    distributed.average_gradients(optimiser_d)
+                    mixed_precision.step(optimiser_d)
+
+                    epoch_report['d loss'] = err_d.item()
+
+                    if is_main and update == 0:
+                        timer.start('images')
+                        artifact_writer.save_image(obs_d.data,
+                                                   '{}/images/real_samples.png'.format(output_dir),
+                                                   normalize=True)
+
+                if train_g_switch is True:
+                    timer.start('g forward')
+                    # train generator using discriminator
+                    # draw states for G training
+                    draw = np.random.choice(bptt_window * pae_batch_size, size=gan_batch_size, replace=False)
+                    states_g = states_nonep[draw, ...]
+
+                    g_noise.data.normal_(0, 1)
+                    state_sample = net.G(g_noise, states_g.detach())
                     obs_sample = net.decoder(state_sample)
-                    vutils.save_image(obs_sample.data,
-                                      '{}/images/fake_samples_epoch_{}.png'.format(output_dir, current_epoch),
-                                      normalize=False)
-
-            if train_av_switch is True:
-                # train generator using averaging
-                # draw random states
-                draw = np.random.choice(EP_LEN * PAE_BATCH_SIZE, size=1, replace=False)
-                states_av = states_nonep[draw, ...]
-                states_av_expanded = states_av.expand(AVERAGING_BATCH_SIZE, -1)
-
-                # get corresponding observation expectation
-                obs_exp_nonep = obs_expectation.view(EP_LEN * PAE_BATCH_SIZE,
-                                                     obs_out.size(2), obs_out.size(3), obs_out.size(4))
-                obs_exp = obs_exp_nonep[draw, ...]
-
-                # generate samples from state
-                averaging_noise.data.normal_(0, 1)
-                n_samples = net.G(averaging_noise, states_av_expanded.detach())
-
-                n_recons = net.decoder(n_samples)
-                sample_av = n_recons.mean(dim=0).unsqueeze(0)
-
-                err_av = criterion_gen_averaged(sample_av, obs_exp.detach())
-
-                # normalise error to ~1
-                losses.append(av_loss_multiplier * err_av)
-                epoch_report['av loss'] = err_av.data[0]
-
-                if update % 50 == 0:
-                    sample_mixture = sample_av.data.cpu().numpy()
-                    observation_belief = obs_exp.data.cpu().numpy()
-                    joint = np.concatenate((observation_belief, sample_mixture), axis=-2)
-                    joint = np.expand_dims(joint, axis=0)
-                    my_utils.batch_to_sequence(joint, fpath='{}/images/sample_av_{}.gif'.format(output_dir, current_epoch))
-
-            if train_av_future_switch is True:
-                assert train_pae_switch is False
-
-                n_steps_ahead = int(np.random.randint(1, N_STEPS_AHEAD))
-
-                # draw random states
-                draw = np.random.choice(EP_LEN * PAE_BATCH_SIZE, size=1, replace=False)
-                states_av_fut = states_nonep[draw, ...]
-                states_av_fut_expanded = states_av_fut.expand(AVERAGING_BATCH_SIZE, -1)
-
-                # generate samples from state
-                averaging_noise.data.normal_(0, 1)
-                n_samples_fut = net.G(averaging_noise, states_av_fut_expanded.detach())
-
-                # get null update (from null observation)
-                null_update = net.bs_prop.encoder(null_observation).detach()
-                # print(null_update.size())
-                null_update_expanded1 = null_update.expand(n_steps_ahead, 1, -1)
-                # print(null_update_expanded1.size())
-                null_update_expanded2 = null_update.expand(n_steps_ahead, AVERAGING_BATCH_SIZE, -1)
-                # print(null_update_expanded2.size())
-
-                # propagate belief in time
-                _, future_belief = net.bs_prop.gru(null_update_expanded1, hx=states_av_fut.view(1, 1, -1))
-                # print(future_belief.size())
-                future_exp = net.decoder(future_belief.view(1, -1))
-
-                # propagate samples in time
-                _, future_samples = net.bs_prop.gru(null_update_expanded2, hx=n_samples_fut.view(1, AVERAGING_BATCH_SIZE, -1))
-                # print(future_samples.size())
-                future_recons = net.decoder(future_samples.view(AVERAGING_BATCH_SIZE, -1))
-
-                future_av = future_recons.mean(dim=0).unsqueeze(0)
-
-                err_future_av = criterion_gen_averaged(future_av, future_exp.detach())
-
-                # normalise error to ~1
-
-                losses.append(av_loss_multiplier * err_future_av)
-                epoch_report['av fut loss'] = err_future_av.data[0]
-
-                if update % 50 == 0:
-                    sample_mixture = future_av.data.cpu().numpy()
-                    observation_belief = future_exp.data.cpu().numpy()
-                    joint = np.concatenate((observation_belief, sample_mixture), axis=-2)
-                    joint = np.expand_dims(joint, axis=0)
-                    my_utils.batch_to_sequence(joint,
-                                                  fpath='{}/images/future_av_{}.gif'.format(output_dir, current_epoch))
+
+                    out_d_g = net.D(obs_sample).view(gan_batch_size, 1)
+                    # print("out_d_g", out_d_g)
+                    err_g = criterion_gan(out_d_g, real_labels)
+                    losses.append(err_g)
+
+                    epoch_report['g loss'] = err_g.item()
+
+                    if is_main and update % 100 == 0:
+                        timer.start('images')
+                        state_sample = net.G(fixed_noise, states_g)
+                        obs_sample = net.decoder(state_sample)
+                        artifact_writer.save_image(obs_sample.data,
+                                                   '{}/images/fake_samples_epoch_{}.png'.format(output_dir,
+                                                                                                current_epoch),
+                                                   normalize=False)
+
+                if train_av_switch is True:
+                    timer.start('averaging')
+                    # train generator using averaging
+                    # draw random states
+                    draw = np.random.choice(bptt_window * pae_batch_size, size=1, replace=False)
+                    states_av = states_nonep[draw, ...]
+                    states_av_expanded = states_av.expand(averaging_batch_size, -1)
+
+                    # get corresponding observation expectation
+                    obs_exp_nonep = obs_expectation.view(bptt_window * pae_batch_size,
+                                                         obs_out.size(2), obs_out.size(3), obs_out.size(4))
+                    obs_exp = obs_exp_nonep[draw, ...]
+
+                    # generate samples from state
+                    averaging_noise.data.normal_(0, 1)
+                    n_samples = net.G(averaging_noise, states_av_expanded.detach())
+
+                    n_recons = net.decoder(n_samples)
+                    sample_av = n_recons.mean(dim=0).unsqueeze(0)
+
+                    err_av = criterion_gen_averaged(sample_av, obs_exp.detach())
+
+                    # normalise error to ~1
+                    losses.append(av_loss_multiplier * err_av)
+                    epoch_report['av loss'] = err_av.item()
+
+                    if is_main and update % 50 == 0:
+                        timer.start('images')
+                        sample_mixture = sample_av.data.float().cpu().numpy()
+                        observation_belief = obs_exp.data.float().cpu().numpy()
+                        joint = np.concatenate((observation_belief, sample_mixture), axis=-2)
+                        joint = np.expand_dims(joint, axis=0)
+                        artifact_writer.save_gif(my_utils.batch_to_sequence, joint,
+                                                 '{}/images/sample_av_{}.gif'.format(output_dir, current_epoch))
+
+                if train_av_future_switch is True:
+                    timer.start('future averaging')
+                    assert train_pae_switch is False
+
+                    n_steps_ahead = int(np.random.randint(1, N_STEPS_AHEAD))
+
+                    # draw random states
+                    draw = np.random.choice(bptt_window * pae_batch_size, size=1, replace=False)
+                    states_av_fut = states_nonep[draw, ...]
+                    states_av_fut_expanded = states_av_fut.expand(averaging_batch_size, -1)
+
+                    # generate samples from state
+                    averaging_noise.data.normal_(0, 1)
+                    n_samples_fut = net.G(averaging_noise, states_av_fut_expanded.detach())
+
+                    # propagate belief and samples in time together, null updates come from the cached null
+                    # observation encoding
+                    future_states = net.bs_prop.rollout(torch.cat([states_av_fut, n_samples_fut], dim=0),
+                                                        n_steps_ahead)[-1]
+                    future_decoded = net.decoder(future_states)
+                    future_exp = future_decoded[:1]
+                    future_recons = future_decoded[1:]
+
+                    future_av = future_recons.mean(dim=0).unsqueeze(0)
+
+                    err_future_av = criterion_gen_averaged(future_av, future_exp.detach())
+
+                    # normalise error to ~1
+
+                    losses.append(av_loss_multiplier * err_future_av)
+                    epoch_report['av fut loss'] = err_future_av.item()
+
+                    if is_main and update % 50 == 0:
+                        timer.start('images')
+                        sample_mixture = future_av.data.float().cpu().numpy()
+                        observation_belief = future_exp.data.float().cpu().numpy()
+                        joint = np.concatenate((observation_belief, sample_mixture), axis=-2)
+                        joint = np.expand_dims(joint, axis=0)
+                        artifact_writer.save_gif(my_utils.batch_to_sequence, joint,
+                                                 '{}/images/future_av_{}.gif'.format(output_dir, current_epoch))
 
             # =====================================
             # UPDATE WEIGHTS HERE!
+            timer.start('backward')
             if len(losses) > 0:
-                sum(losses).backward()
+                mixed_precision.backward(sum(losses))
+
+            if world_size > 1:
+                timer.start('all-reduce')
+                if train_pae_switch:
+                    distributed.average_gradients(optimiser_pae)
+                if train_g_switch or train_av_switch:
+                    distributed.average_gradients(optimiser_g)
 
+            timer.start('optimiser')
             if train_pae_switch:
-                optimiser_pae.step()
+                mixed_precision.step(optimiser_pae)
 
             if train_g_switch or train_av_switch:
-                optimiser_g.step()
-
-            # pae validation error and image record
-            if update % 100 == 0:
-                batch = valid_getter()
-                masked, masked_indices = my_utils.mask_percepts(batch, p=p_mask, return_indices=True)
+                mixed_precision.step(optimiser_g)
 
-                batch = batch.transpose((1, 0, 4, 2, 3))
-                masked = masked.transpose((1, 0, 4, 2, 3))
+            mixed_precision.update()
+            chunk_start = (chunk_start + bptt_window) % ep_len
 
-                batch = torch.FloatTensor(batch)
-                masked = torch.FloatTensor(masked)
+            # pae validation error and image record
+            if is_main and update % 100 == 0:
+                timer.start('validation')
+                masked, batch, masked_indices = valid_getter.get()
 
-                obs_in.data.copy_(masked)
-                obs_out.data.copy_(batch)
+                # not in the episode buffers, which may still hold the rest of the streamed training episodes
+                valid_in = masked.to(episode_in.device, non_blocking=True)
+                valid_out = batch.to(episode_in.device, non_blocking=True)
+                valid_mask = masked_indices.to(episode_in.device, non_blocking=True)
 
-                # generate beliefs states
-                states_ep = net.bs_prop(obs_in)
-                states_nonep = states_ep.view(EP_LEN * PAE_BATCH_SIZE, -1)
+                with torch.no_grad(), mixed_precision.autocast():
+                    # generate beliefs states
+                    states_ep = net.bs_prop(valid_in)
+                    states_nonep = states_ep.view(ep_len * pae_batch_size, -1)
 
-                obs_expectation = net.decoder(states_nonep).view(obs_in.size())
+                    obs_expectation = net.decoder(states_nonep).view(valid_in.size())
 
-                if reward_only_masked:
-                    masked_indices = torch.ByteTensor(masked_indices.astype('int')).nonzero()
-                    if use_cuda:
-                        masked_indices = masked_indices.cuda()
-                    err_valid_pae = criterion_pae(obs_expectation[masked_indices, :, ...], obs_out[masked_indices, :, ...])
-                else:
-                    err_valid_pae = criterion_pae(obs_expectation, obs_out)
-                epoch_report['pae valid loss'] = err_valid_pae.data[0]
+                    if reward_only_masked:
+                        err_valid_pae = criterion_pae_masked(obs_expectation, valid_out, valid_mask)
+                    else:
+                        err_valid_pae = criterion_pae(obs_expectation, valid_out)
+                    epoch_report['pae valid loss'] = err_valid_pae.item()
 
                 # print a gif
                 if update % 500 == 0:
-                    recon_ims = obs_expectation.data.cpu().numpy()
-                    target_ims = obs_out.data.cpu().numpy()
+                    timer.start('images')
+                    recon_ims = obs_expectation.data.float().cpu().numpy()
+                    target_ims = valid_out.float().cpu().numpy()
                     joint = np.concatenate((target_ims, recon_ims), axis=-2)
-                    my_utils.batch_to_sequence(joint, fpath='{}/images/valid_recon_{}.gif'.format(output_dir, current_epoch))
+                    artifact_writer.save_gif(my_utils.batch_to_sequence, joint,
+                                             '{}/images/valid_recon_{}.gif'.format(output_dir, current_epoch))
 
+            timer.end_update()
             bar.set_postfix(**epoch_report)
 
-        torch.save(net.state_dict(), '{}/network/paegan_epoch_{}.pth'.format(output_dir, current_epoch))
-        if compare_with_pf:
-            my_utils.pf_comparison(net, sim_config, output_dir, current_epoch)
+        # replicas are identical apart from D's BatchNorm statistics, rank 0 writes for all of them
+        distributed.average_buffers(net)
+        if is_main:
+            timer.start('checkpoint')
+            torch.save(net.state_dict(), '{}/network/paegan_epoch_{}.pth'.format(output_dir, current_epoch))
+            if compare_with_pf:
+                timer.start('pf comparison')
+                my_utils.pf_comparison(net, sim_config, output_dir, current_epoch, writer=artifact_writer)
+            timer.stop()
+
+            timing = timer.write_summary('{}/numerical/timing_epoch_{}.json'.format(output_dir, current_epoch),
+                                         epoch=current_epoch, training_stage=training_stage, world_size=world_size,
+                                         artifacts_dropped=artifact_writer.n_dropped)
+            print(profiling.format_summary(timing))
+        timer.reset()
+
+    profiler_window.close()
+    train_getter.close()
+    valid_getter.close()
+    artifact_writer.close()
+    distributed.close()
 